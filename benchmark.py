@@ -0,0 +1,340 @@
+"""
+Throughput benchmarks for db_utils and encrypt using synthetic data for the model tables.
+Run this file directly, e.g. to benchmark inserts and upserts of 100k rows:
+
+    python benchmark.py --rows 100000 --benchmarks insert upsert
+
+Each case runs in a fresh process against a local SQLite file so peak memory is
+comparable. Use --out to save results as JSON and --compare to show the change from
+a previous run. The encrypt and decrypt benchmarks run once per cipher in --ciphers,
+to compare MB/s between encrypt.CIPHERS and the legacy format.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import inspect
+import logging
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from sqlmodel import SQLModel, Session, create_engine
+
+try:
+    from . import db_utils, encrypt, metrics_utils, model
+except ImportError:
+    import db_utils, encrypt, metrics_utils, model
+
+
+# All table classes exported by the model package, by table name
+TABLES = {
+    obj.__tablename__: obj
+    for obj in vars(model).values()
+    if inspect.isclass(obj) and issubclass(obj, SQLModel) and hasattr(obj, "__table__")
+}
+
+BENCHMARKS = ("convert", "insert", "upsert", "encrypt", "decrypt")
+
+# Benchmarks that are run once per cipher, and the ciphers to choose from
+CIPHER_BENCHMARKS = ("encrypt", "decrypt")
+CIPHERS = (*encrypt.CIPHERS, "legacy")
+
+# Range of generated datetimes
+_DATETIME_START = np.datetime64("2015-01-01T00:00:00", "s")
+_DATETIME_RANGE_SECONDS = 10 * 365 * 24 * 3600
+
+
+def generate_table_df(
+    table: SQLModel, rows: int, seed: int = 0, null_frac: float = 0.1
+) -> pd.DataFrame:
+    """
+    Generate a dataframe of random data for all columns of table. Honors column types,
+    string max_length, single character class regex constraints, uniqueness and
+    nullability (null_frac of values in nullable columns are missing).
+    """
+    rng = np.random.default_rng(seed)
+    plan = db_utils._get_dtype_plan(table)
+    unique_cols = {
+        col.name for idx in table.__table__.indexes if idx.unique for col in idx.columns
+    }
+
+    data = {}
+    for col in table.__table__.columns:
+        kind = plan[col.name]
+        unique = col.primary_key or col.unique or col.name in unique_cols
+        if kind == "int":
+            if unique:
+                values = np.arange(1, rows + 1, dtype=np.int64)
+            else:
+                values = rng.integers(0, 100, rows)
+        elif kind == "float":
+            values = np.round(rng.random(rows) * 1000, 2)
+        elif kind == "datetime":
+            offsets = rng.integers(0, _DATETIME_RANGE_SECONDS, rows)
+            values = _DATETIME_START + offsets.astype("timedelta64[s]")
+        elif kind == "bool":
+            values = rng.random(rows) < 0.5
+        else:
+            max_length = getattr(col.type, "length", None) or 32
+            choices = _get_field_choices(table, col.name)
+            if choices:
+                values = rng.choice(choices, rows)
+            elif unique:
+                values = _unique_strings(col.name, rows, max_length)
+            else:
+                values = _random_strings(rng, rows, max_length)
+
+        series = pd.Series(values, name=col.name)
+        if col.nullable and not unique:
+            series = series.mask(rng.random(rows) < null_frac)
+        data[col.name] = series
+
+    return pd.DataFrame(data)
+
+
+def _get_field_choices(table: SQLModel, name: str) -> list[str] | None:
+    """
+    Allowed values for a field constrained by a regex like ^[MFO]$, or None
+    """
+    field = table.model_fields.get(name)
+    regex = getattr(field, "_attributes_set", {}).get("regex") if field else None
+    match = re.fullmatch(r"\^\[(\w+)\]\$", regex or "")
+    return list(match.group(1)) if match else None
+
+
+def _unique_strings(name: str, rows: int, max_length: int) -> np.ndarray:
+    """
+    Unique strings made from a column name prefix and a row number
+    """
+    width = len(str(rows))
+    prefix = name[: max(0, max_length - width)]
+    return np.array([f"{prefix}{i:0{width}d}" for i in range(rows)], dtype=object)
+
+
+def _random_strings(rng: np.random.Generator, rows: int, max_length: int) -> np.ndarray:
+    """
+    Strings of random letters up to max_length characters, drawn from a pool of 1000 so
+    values repeat like real categorical data
+    """
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz0123456789 "))
+    lengths = rng.integers(1, min(max_length, 24) + 1, 1000)
+    pool = np.array(
+        ["".join(rng.choice(letters, length)) for length in lengths], dtype=object
+    )
+    return pool[rng.integers(0, len(pool), rows)]
+
+
+def run_case(
+    benchmark: str,
+    table_name: str,
+    rows: int,
+    db_path: str,
+    writer: str,
+    cipher: str = None,
+) -> dict:
+    """
+    Run a single benchmark case and return its result. Intended to run in a fresh process.
+    """
+    table = TABLES[table_name]
+    df = generate_table_df(table, rows)
+    base_rss = metrics_utils.get_peak_rss()
+    result = {
+        "benchmark": benchmark,
+        "table": table_name,
+        "rows": rows,
+        "writer": writer if benchmark in ("insert", "upsert") else None,
+        "cipher": cipher if benchmark in CIPHER_BENCHMARKS else None,
+        "seconds": None,
+        "bytes": None,
+    }
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    table.metadata.drop_all(engine, tables=[table.__table__])
+    table.metadata.create_all(engine, tables=[table.__table__])
+
+    if benchmark == "convert":
+        start_time = time.perf_counter()
+        db_utils._prepare_df_for_insert(db_utils.TableData(table, df))
+        result["seconds"] = time.perf_counter() - start_time
+
+    elif benchmark == "insert":
+        with Session(engine) as session:
+            start_time = time.perf_counter()
+            db_utils.clear_tables_and_insert_data(
+                session, [db_utils.TableData(table, df)], writer=writer
+            )
+            result["seconds"] = time.perf_counter() - start_time
+
+    elif benchmark == "upsert":
+        # Load half the rows first so the timed upsert is half updates, half inserts
+        with Session(engine) as session:
+            existing = df.iloc[: rows // 2]
+            db_utils.upsert_data(
+                session, [db_utils.TableData(table, existing)], writer=writer
+            )
+            start_time = time.perf_counter()
+            db_utils.upsert_data(
+                session, [db_utils.TableData(table, df)], writer=writer
+            )
+            result["seconds"] = time.perf_counter() - start_time
+
+    elif benchmark in CIPHER_BENCHMARKS:
+        csv_path = f"{db_path}.{table_name}.csv"
+        df.to_csv(csv_path, index=False)
+        result["bytes"] = os.path.getsize(csv_path)
+        key = encrypt.generate_key()
+        if cipher == "legacy":
+            kwargs = {"legacy": True}
+        else:
+            kwargs = {"cipher": cipher or encrypt.DEFAULT_CIPHER}
+        start_time = time.perf_counter()
+        encrypt.encrypt_file(csv_path, f"{csv_path}.enc", key, **kwargs)
+        if benchmark == "decrypt":
+            start_time = time.perf_counter()
+            encrypt.decrypt_file(f"{csv_path}.enc", f"{csv_path}.dec", key)
+            os.remove(f"{csv_path}.dec")
+        result["seconds"] = time.perf_counter() - start_time
+        os.remove(csv_path)
+        os.remove(f"{csv_path}.enc")
+
+    engine.dispose()
+    result["rows_per_sec"] = rows / result["seconds"] if result["seconds"] else None
+    result["mb_per_sec"] = (
+        result["bytes"] / 2**20 / result["seconds"]
+        if result["bytes"] and result["seconds"]
+        else None
+    )
+    result["base_rss_mb"] = (base_rss or 0) / 2**20
+    result["peak_rss_mb"] = (metrics_utils.get_peak_rss() or 0) / 2**20
+    return result
+
+
+def run_benchmarks(
+    tables: list[str],
+    rows_list: list[int],
+    benchmarks: list[str],
+    db_path: str,
+    writer: str = "auto",
+    ciphers: list[str] = CIPHERS,
+) -> list[dict]:
+    """
+    Run every combination of benchmark, table and row count, plus cipher for the
+    encrypt and decrypt benchmarks, each in a new process
+    """
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for rows in rows_list:
+        for benchmark in benchmarks:
+            for table_name in tables:
+                for cipher in ciphers if benchmark in CIPHER_BENCHMARKS else [None]:
+                    with ctx.Pool(processes=1) as pool:
+                        result = pool.apply(
+                            run_case,
+                            (benchmark, table_name, rows, db_path, writer, cipher),
+                        )
+                    print(_format_result(result), flush=True)
+                    results.append(result)
+    return results
+
+
+def _format_result(result: dict, previous: dict = None) -> str:
+    name = f"{result['benchmark']:<8} {result['table']:<24} {result['rows']:>9}"
+    if result.get("cipher"):
+        name += f"  {result['cipher']:<17}"
+    line = (
+        f"{name}  {result['seconds']:8.2f}s  {result['rows_per_sec']:12,.0f} rows/s"
+        f"  peak {result['peak_rss_mb']:8.1f} MB"
+    )
+    if result["mb_per_sec"]:
+        line += f"  {result['mb_per_sec']:8.1f} MB/s"
+    if previous and previous.get("rows_per_sec"):
+        change = result["rows_per_sec"] / previous["rows_per_sec"] - 1
+        line += f"  ({change:+.1%} vs previous)"
+    return line
+
+
+def _result_key(result: dict) -> tuple:
+    return (
+        result["benchmark"],
+        result["table"],
+        result["rows"],
+        result["writer"],
+        result.get("cipher"),
+    )
+
+
+# Run as script. See module docstring for usage.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark db_utils and encrypt throughput using synthetic data"
+    )
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        default=list(TABLES),
+        choices=list(TABLES),
+        metavar="TABLE",
+        help="Table names to benchmark. Defaults to all tables in model/.",
+    )
+    parser.add_argument(
+        "--rows",
+        nargs="+",
+        type=int,
+        default=[10000],
+        help="Row counts to benchmark, e.g. --rows 10000 1000000",
+    )
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=list(BENCHMARKS),
+        choices=BENCHMARKS,
+        help="Benchmarks to run. Defaults to all.",
+    )
+    parser.add_argument(
+        "--writer",
+        default="auto",
+        help="Bulk writer for insert and upsert, see db_utils.BULK_WRITERS",
+    )
+    parser.add_argument(
+        "--ciphers",
+        nargs="+",
+        default=list(CIPHERS),
+        choices=CIPHERS,
+        help="Ciphers for encrypt and decrypt benchmarks. Defaults to all.",
+    )
+    parser.add_argument("--db", help="SQLite file to use. Defaults to a temp file.")
+    parser.add_argument("--out", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="JSON results from a previous run to compare")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+    results = run_benchmarks(
+        args.tables, args.rows, args.benchmarks, db_path, args.writer, args.ciphers
+    )
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {_result_key(r): r for r in json.load(f)["results"]}
+        print(f"\nCompared to {args.compare}:")
+        for result in results:
+            print(_format_result(result, previous.get(_result_key(result))))
+
+    if args.out:
+        report = {
+            "created": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "pandas": pd.__version__,
+            "results": results,
+        }
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.out}")
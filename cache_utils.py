@@ -0,0 +1,165 @@
+"""
+Local Parquet read cache for warehouse tables.
+
+Warehouse data only changes when an ingest runs, which records the time in PrwMeta or
+PrwSourcesMeta. ParquetCache.read_table() checks that timestamp with a single-row
+query, and returns a local Parquet snapshot of the table if it was taken at the same
+timestamp. Otherwise it reads the table with db_utils.read_table() and saves a new
+snapshot. Least recently used snapshots are removed when the cache exceeds its size
+limit. Requires pyarrow.
+
+Usage:
+    cache = ParquetCache("~/.cache/prw")
+    with Session(engine) as session:
+        df = cache.read_table(session, PrwEncounterOutpt, dataset="prw")
+"""
+
+import os
+import glob
+import hashlib
+import logging
+import threading
+import sqlalchemy
+import pandas as pd
+from datetime import datetime
+from typing import List
+from sqlmodel import SQLModel, Session, select
+
+try:
+    from . import db_utils, metrics_utils
+    from .model import PrwMeta
+except ImportError:
+    import db_utils, metrics_utils
+    from model import PrwMeta
+
+
+# Default size limit of the cache directory
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+
+class ParquetCache:
+    """
+    Read-through cache of table snapshots stored as Parquet files in cache_dir, limited
+    to max_bytes in total
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def read_table(
+        self,
+        session: Session,
+        table: SQLModel,
+        dataset: str = None,
+        meta_table: SQLModel = PrwMeta,
+        columns: List[str] = None,
+        where: sqlalchemy.ColumnElement | List[sqlalchemy.ColumnElement] = None,
+    ) -> pd.DataFrame:
+        """
+        Return the rows of table, from the cache if the snapshot is current. See
+        db_utils.read_table() for columns and where.
+
+        Freshness is the modified time in meta_table for dataset, e.g. PrwMeta and a
+        dataset name, or PrwSourcesMeta and a source name. If dataset is None, the
+        most recent modified time in meta_table is used. If there is no modified
+        time, the table is read from the DB without caching.
+        """
+        modified = get_modified(session, meta_table, dataset)
+        if modified is None:
+            logging.info(
+                f"No modified time for {dataset}, not caching {table.__tablename__}"
+            )
+            return db_utils.read_table(session, table, columns=columns, where=where)
+
+        prefix = self._get_prefix(session, table, dataset, columns, where)
+        path = f"{prefix}-{modified.strftime('%Y%m%dT%H%M%S%f')}.parquet"
+        table_name = table.__tablename__
+        if os.path.exists(path):
+            with metrics_utils.stage(table_name, "cache_read") as stage:
+                df = pd.read_parquet(path, memory_map=True)
+                stage.rows = len(df)
+            # Mark as recently used for eviction
+            os.utime(path)
+            logging.info(f"Read {len(df)} rows for {table_name} from cache")
+            return df
+
+        df = db_utils.read_table(session, table, columns=columns, where=where)
+        with self._lock:
+            # Replace outdated snapshots of the same query
+            for stale_path in glob.glob(f"{glob.escape(prefix)}-*.parquet"):
+                os.remove(stale_path)
+            tmp_path = f"{path}.tmp"
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            self._evict(keep=path)
+        return df
+
+    def clear(self):
+        """
+        Remove all cached snapshots
+        """
+        with self._lock:
+            for path in glob.glob(os.path.join(self.cache_dir, "*.parquet")):
+                os.remove(path)
+
+    def _get_prefix(
+        self,
+        session: Session,
+        table: SQLModel,
+        dataset: str | None,
+        columns: List[str] | None,
+        where,
+    ) -> str:
+        """
+        Path prefix for snapshots of a query, unique per dataset, table, columns and filter
+        """
+        where_sql = ""
+        if where is not None:
+            where_list = where if isinstance(where, (list, tuple)) else [where]
+            where_sql = " AND ".join(
+                str(
+                    w.compile(
+                        dialect=session.bind.dialect,
+                        compile_kwargs={"literal_binds": True},
+                    )
+                )
+                for w in where_list
+            )
+        key = repr((dataset, table.__tablename__, columns, where_sql))
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{table.__tablename__}-{digest}")
+
+    def _evict(self, keep: str):
+        """
+        Remove least recently used snapshots until the cache fits in max_bytes
+        """
+        paths = glob.glob(os.path.join(self.cache_dir, "*.parquet"))
+        stats = {path: os.stat(path) for path in paths}
+        total = sum(stat.st_size for stat in stats.values())
+        for path in sorted(paths, key=lambda path: stats[path].st_mtime):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            logging.info(f"Evicting {os.path.basename(path)} from cache")
+            os.remove(path)
+            total -= stats[path].st_size
+
+
+def get_modified(
+    session: Session, meta_table: SQLModel, dataset: str = None
+) -> datetime | None:
+    """
+    Return the modified time recorded in meta_table for dataset, which is matched
+    against the table's dataset or source column. If dataset is None, return the most
+    recent modified time.
+    """
+    stmt = select(meta_table.modified)
+    if dataset is not None:
+        key_col = "dataset" if "dataset" in meta_table.__table__.columns else "source"
+        stmt = stmt.where(meta_table.__table__.columns[key_col] == dataset)
+    stmt = stmt.order_by(meta_table.modified.desc()).limit(1)
+    return session.exec(stmt).first()
@@ -1,22 +1,49 @@
-import json, re, urllib, logging
+import functools, io, json, random, re, threading, urllib, logging
+import numpy as np
 import pandas as pd
 import sqlalchemy
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Iterable, Iterator, List
 from sqlmodel import SQLModel, Session, create_engine, delete, select
 from sqlalchemy import inspect
 
+try:
+    from . import metrics_utils
+except ImportError:
+    import metrics_utils
+
 
 @dataclass
 class TableData:
     """
-    Associate a table with its data to update in a DB
+    Associate a table with its data to update in a DB.
+
+    df may be a single DataFrame, or an iterable of DataFrame chunks, such as from
+    pd.read_sql(..., chunksize=) or pd.read_csv(..., chunksize=), which is consumed once
+    and written without materializing the full table in memory.
     """
 
     table: SQLModel
-    df: pd.DataFrame
+    df: pd.DataFrame | Iterable[pd.DataFrame]
+
+
+@dataclass
+class TableResult:
+    """
+    Outcome of writing one TableData to the DB
+    """
+
+    table_name: str
+    rows: int = 0
+    elapsed: float = 0.0
+    error: Exception | None = None
+    # Set by upsert_data(skip_unchanged=True)
+    inserted: int | None = None
+    updated: int | None = None
+    unchanged: int | None = None
 
 
 def mask_conn_pw(conn_str: str) -> str:
@@ -28,17 +55,55 @@ def mask_conn_pw(conn_str: str) -> str:
     return masked_str
 
 
+@dataclass
+class EngineStats:
+    """
+    Connection statistics for an engine created by get_db_connection()
+    """
+
+    connects: int = 0
+    connect_time: float = 0.0
+    checkouts: int = 0
+
+    @property
+    def avg_connect_time(self) -> float:
+        return self.connect_time / self.connects if self.connects else 0.0
+
+
+# Process-wide engines and their stats, keyed by connection string and engine options
+_engines: dict[tuple, sqlalchemy.Engine] = {}
+_engine_stats: dict[tuple, EngineStats] = {}
+_engines_lock = threading.Lock()
+
+
 def get_db_connection(
-    conn_str: str, echo: bool = False, max_retries: int = 3, retry_delay: int = 10
+    conn_str: str,
+    echo: bool = False,
+    max_retries: int = 3,
+    retry_delay: int = 10,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_recycle: int = 1800,
+    cache: bool = True,
 ) -> sqlalchemy.Engine:
     """
     Given an ODBC connection string, return a connection to the DB via SQLModel
 
+    Engines are cached for the life of the process, so repeated calls with the same
+    connection string share one connection pool instead of reconnecting. Pooled
+    connections are checked with a ping before use and recycled before Azure SQL's idle
+    timeout closes them.
+
     Args:
         odbc_str: ODBC connection string
         echo: Whether to echo SQL statements
         max_retries: Maximum number of connection retry attempts
-        retry_delay: Delay in seconds between retry attempts
+        retry_delay: Base delay in seconds between retry attempts. Doubles after each
+            attempt, with random jitter.
+        pool_size: Number of connections to keep open in the pool
+        max_overflow: Number of connections allowed beyond pool_size
+        pool_recycle: Seconds after which a pooled connection is replaced
+        cache: Whether to reuse a previously created engine for the same arguments
     """
     # Split connection string into odbc prefix and parameters (ie everything after odbc_connect=)
     match = re.search(r"^(.*odbc_connect=)(.*)$", conn_str)
@@ -48,31 +113,132 @@ def get_db_connection(
         # URL escape ODBC connection string if found
         conn_str = prefix + urllib.parse.quote_plus(params)
 
-    # Use SQLModel to establish connection to DB with retries
+    key = (conn_str, echo, pool_size, max_overflow, pool_recycle)
+    with _engines_lock:
+        if cache and key in _engines:
+            return _engines[key]
+        stats = _engine_stats.setdefault(key, EngineStats())
+
+    # Use SQLModel to establish connection to DB with retries. The lock is not held
+    # here, so retrying one DB does not block connections to others.
     retries = 0
     while retries < max_retries:
+        engine = None
         try:
-            if conn_str.startswith("mssql"):
-                # Optimize with fast_executemany, which is supported by MSSQL / Azure SQL
-                engine = create_engine(conn_str, echo=echo, fast_executemany=True)
-            else:
-                engine = create_engine(conn_str, echo=echo)
+            engine = _create_pooled_engine(
+                conn_str, echo, pool_size, max_overflow, pool_recycle, stats
+            )
 
             # Validate by initiating connection
             engine.connect().close()
+            if not cache:
+                return engine
+            with _engines_lock:
+                # Use the engine created by another thread if it finished first
+                if key in _engines:
+                    engine.dispose()
+                    return _engines[key]
+                _engines[key] = engine
             return engine
         except Exception as e:
+            if engine is not None:
+                engine.dispose()
             retries += 1
-            if retries == max_retries:
+            if retries == max_retries or not _is_transient_db_error(e):
                 logging.error(
-                    f"ERROR: failed to connect to DB after {max_retries} attempts"
+                    f"ERROR: failed to connect to DB after {retries} attempts"
                 )
                 logging.error(e)
+                with _engines_lock:
+                    if key not in _engines:
+                        _engine_stats.pop(key, None)
                 return None
+            delay = retry_delay * 2 ** (retries - 1)
+            delay += random.uniform(0, delay)
             logging.warning(
-                f"Connection attempt {retries} failed, retrying in {retry_delay} seconds..."
+                f"Connection attempt {retries} failed, retrying in {delay:.1f} seconds..."
             )
-            time.sleep(retry_delay)
+            time.sleep(delay)
+
+
+def get_db_connection_stats() -> dict[str, EngineStats]:
+    """
+    Return connection stats for each cached engine, keyed by masked connection string
+    """
+    with _engines_lock:
+        return {mask_conn_pw(key[0]): stats for key, stats in _engine_stats.items()}
+
+
+def dispose_db_connections():
+    """
+    Close all pooled connections and clear the engine cache
+    """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _engine_stats.clear()
+
+
+def _create_pooled_engine(
+    conn_str: str,
+    echo: bool,
+    pool_size: int,
+    max_overflow: int,
+    pool_recycle: int,
+    stats: EngineStats,
+) -> sqlalchemy.Engine:
+    """
+    Create an engine with pooling options for the dialect, and record connection stats
+    in stats
+    """
+    kwargs = {"echo": echo, "pool_pre_ping": True, "pool_recycle": pool_recycle}
+    if conn_str.startswith("mssql"):
+        # Optimize with fast_executemany, which is supported by MSSQL / Azure SQL
+        kwargs["fast_executemany"] = True
+    if not conn_str.startswith("sqlite"):
+        # SQLite uses its own pool classes that do not take size options
+        kwargs["pool_size"] = pool_size
+        kwargs["max_overflow"] = max_overflow
+    engine = create_engine(conn_str, **kwargs)
+
+    # Time establishing each new DB connection, and count pool checkouts
+    connect_start = threading.local()
+
+    @sqlalchemy.event.listens_for(engine, "do_connect")
+    def on_do_connect(dialect, conn_rec, cargs, cparams):
+        connect_start.time = time.perf_counter()
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def on_connect(dbapi_conn, conn_rec):
+        start = getattr(connect_start, "time", None)
+        if start is not None:
+            stats.connects += 1
+            stats.connect_time += time.perf_counter() - start
+            connect_start.time = None
+
+    @sqlalchemy.event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_conn, conn_rec, conn_proxy):
+        stats.checkouts += 1
+
+    return engine
+
+
+def _is_transient_db_error(e: Exception) -> bool:
+    """
+    Whether a connection error may succeed on retry, such as a timeout or a DB that is
+    still resuming, as opposed to a bad connection string or missing driver
+    """
+    return isinstance(
+        e,
+        (
+            sqlalchemy.exc.OperationalError,
+            sqlalchemy.exc.InterfaceError,
+            sqlalchemy.exc.TimeoutError,
+            TimeoutError,
+            ConnectionError,
+        ),
+    )
 
 
 def clear_tables(session: Session, tables: List[SQLModel]):
@@ -82,115 +248,1370 @@ def clear_tables(session: Session, tables: List[SQLModel]):
     for table in tables:
         logging.info(f"Clearing table: {table.__tablename__}")
         session.exec(delete(table))
+        _drop_digest_table(session, table)
 
 
 def clear_tables_and_insert_data(
-    session: Session, tables_data: List[TableData], chunk_size: int = 100000
-):
+    session: Session,
+    tables_data: List[TableData],
+    chunk_size: int = 100000,
+    swap: bool = False,
+    writer: str | Callable = "auto",
+    max_workers: int = 1,
+    raise_on_error: bool = True,
+) -> List[TableResult]:
     """
     Write data from dataframes to DB tables, clearing and overwriting existing tables
+
+    With swap=True, data is loaded into a shadow table without secondary indexes, the
+    indexes are built, and the shadow table then replaces the existing table in a single
+    transaction. Readers see the old data until the swap commits instead of an empty table.
+
+    writer selects the bulk insert backend, see bulk_insert_df(). max_workers > 1 writes
+    tables concurrently, and raise_on_error=False returns each table's error in its
+    result instead of raising, see _write_tables().
     """
-    for table_data in tables_data:
+
+    def write_table(session: Session, table_data: TableData) -> int:
         logging.info(
-            f"Writing data to table: {table_data.table.__tablename__}, rows: {len(table_data.df)}"
+            f"Writing data to table: {table_data.table.__tablename__}, rows: {_describe_len(table_data.df)}"
         )
 
         # Clear data in DB if table exists
-        try:
-            inspector = inspect(session.bind)
-            if inspector.has_table(table_data.table.__tablename__):
-                session.exec(delete(table_data.table))
-                session.commit()
-        except Exception as e:
-            logging.warning(
-                f"WARN: failed to clear table: {table_data.table.__tablename__}", e
-            )
+        if not swap:
+            try:
+                inspector = inspect(session.bind)
+                if inspector.has_table(table_data.table.__tablename__):
+                    with metrics_utils.stage(table_data.table.__tablename__, "clear"):
+                        session.exec(delete(table_data.table))
+                        session.commit()
+            except Exception as e:
+                logging.warning(
+                    f"WARN: failed to clear table: {table_data.table.__tablename__}", e
+                )
 
-        # Prepare dataframe for DB by keeping shared columns and converting dtypes
-        df = _prepare_df_for_insert(table_data)
+        # Row digests from upsert_data(skip_unchanged=True) no longer match the table
+        _drop_digest_table(session, table_data.table)
 
-        # Remove the PK column for insert operations, which will be computed by the DB
-        pk_col = table_data.table.__table__.primary_key.columns.keys()[0]
-        if pk_col in df.columns:
-            df = df.drop(columns=[pk_col])
+        # Prepare each chunk for DB by keeping shared columns and converting dtypes.
+        # Remove the PK column if it will be computed by the DB, otherwise keep it.
+        drop_pk = table_data.table.__table__.autoincrement_column is not None
+        chunks = _iter_prepared_chunks(table_data, chunk_size, drop_pk=drop_pk)
 
         # Write data from dataframe
         start_time = time.time()
         logging.info(f"Writing table: {table_data.table.__tablename__}")
-        df.to_sql(
-            name=table_data.table.__tablename__,
-            con=session.connection(),
-            if_exists="append",
-            index=False,
-            chunksize=chunk_size,
+        if swap:
+            nrows = _insert_data_with_swap(
+                session, table_data.table, chunks, chunk_size, writer
+            )
+        else:
+            nrows = 0
+            for chunk in chunks:
+                bulk_insert_df(
+                    session.connection(),
+                    table_data.table.__tablename__,
+                    chunk,
+                    chunk_size=chunk_size,
+                    writer=writer,
+                )
+                nrows += len(chunk)
+            with metrics_utils.stage(table_data.table.__tablename__, "commit"):
+                session.commit()
+        elapsed_time = time.time() - start_time
+        logging.info(
+            f"Wrote {nrows} rows to {table_data.table.__tablename__} in {elapsed_time:.2f}s"
         )
+        return nrows
+
+    return _write_tables(session, tables_data, write_table, max_workers, raise_on_error)
+
+
+def _insert_data_with_swap(
+    session: Session,
+    table: SQLModel,
+    chunks: Iterable[pd.DataFrame],
+    chunk_size: int,
+    writer: str | Callable,
+) -> int:
+    """
+    Load chunks into a shadow copy of table, build its indexes, then atomically replace
+    table with the shadow copy. Returns the number of rows written.
+    """
+    shadow = _create_shadow_table(session, table)
+    try:
+        # Load data, then build indexes once over the full table
+        nrows = 0
+        for chunk in chunks:
+            bulk_insert_df(
+                session.connection(),
+                shadow.name,
+                chunk,
+                chunk_size=chunk_size,
+                writer=writer,
+                metrics_name=table.__tablename__,
+            )
+            nrows += len(chunk)
         session.commit()
-        elapsed_time = time.time() - start_time
+
+        _swap_in_shadow_table(session, table, shadow)
+        return nrows
+    except Exception:
+        _drop_shadow_table(session, table, shadow)
+        raise
+
+
+def _create_shadow_table(session: Session, table: SQLModel) -> sqlalchemy.Table:
+    """
+    Create an empty <table>_shadow with the same columns and keys as table, but no
+    secondary indexes. Replaces any shadow table left over from a previous run.
+    """
+    target = table.__table__
+    shadow_cols = []
+    for col in target.columns:
+        shadow_col = col._copy()
+        if col.index:
+            shadow_col.index = None
+            shadow_col.unique = None
+        shadow_cols.append(shadow_col)
+    shadow = sqlalchemy.Table(
+        f"{target.name}_shadow", sqlalchemy.MetaData(), *shadow_cols
+    )
+    conn = session.connection()
+    shadow.drop(conn, checkfirst=True)
+    shadow.create(conn)
+    session.commit()
+    return shadow
+
+
+def _drop_shadow_table(session: Session, table: SQLModel, shadow: sqlalchemy.Table):
+    """
+    Discard a shadow table after a failed load. If table no longer exists, the shadow
+    table holds the only copy of the data and is kept.
+    """
+    session.rollback()
+    conn = session.connection()
+    if not inspect(conn).has_table(table.__tablename__):
+        logging.error(
+            f"ERROR: {table.__tablename__} is missing, keeping data in {shadow.name}"
+        )
+        return
+    shadow.drop(conn, checkfirst=True)
+    session.commit()
+
+
+def _swap_in_shadow_table(session: Session, table: SQLModel, shadow: sqlalchemy.Table):
+    """
+    Build the secondary indexes of table on the loaded shadow table, then drop table and
+    rename the shadow table and its indexes into its place in a single transaction.
+
+    SQLite cannot rename indexes, so there the indexes are built once under their final
+    names inside the swap transaction instead.
+    """
+    target = table.__table__
+    is_sqlite = session.bind.dialect.name == "sqlite"
+    index_names = {}
+    if not is_sqlite:
+        logging.info(f"Building indexes on {shadow.name}")
+        with metrics_utils.stage(target.name, "index"):
+            conn = session.connection()
+            for idx in target.indexes:
+                shadow_idx = sqlalchemy.Index(
+                    f"{idx.name}_shadow",
+                    *[shadow.c[col.name] for col in idx.columns],
+                    unique=idx.unique,
+                )
+                shadow_idx.create(conn)
+                index_names[shadow_idx.name] = idx
+            session.commit()
+
+    # Swap in a single transaction: drop old table, then rename shadow table and indexes
+    logging.info(f"Swapping {shadow.name} -> {target.name}")
+    with metrics_utils.stage(target.name, "swap"):
+        conn = session.connection()
+        dbapi_conn = conn.connection.dbapi_connection
+        if conn.dialect.name == "sqlite" and not dbapi_conn.in_transaction:
+            # pysqlite does not begin a transaction before DDL, so without this the drop
+            # is visible to other connections and not undone by a rollback
+            conn.exec_driver_sql("BEGIN")
+        target.drop(conn, checkfirst=True)
+        _drop_digest_table(session, table)
+        _rename_table(conn, shadow.name, target.name)
+        for shadow_idx_name, idx in index_names.items():
+            _rename_index(conn, target.name, shadow_idx_name, idx)
+        if is_sqlite:
+            with metrics_utils.stage(target.name, "index"):
+                for idx in target.indexes:
+                    idx.create(conn)
+        session.commit()
+
+
+def _rename_table(conn: sqlalchemy.Connection, old_name: str, new_name: str):
+    """
+    Rename a table using the connection's dialect
+    """
+    q = conn.dialect.identifier_preparer.quote
+    if conn.dialect.name == "mssql":
+        conn.execute(
+            sqlalchemy.text("EXEC sp_rename :old, :new"),
+            {"old": old_name, "new": new_name},
+        )
+    else:
+        conn.execute(
+            sqlalchemy.text(f"ALTER TABLE {q(old_name)} RENAME TO {q(new_name)}")
+        )
+
+
+def _rename_index(
+    conn: sqlalchemy.Connection, table_name: str, old_name: str, idx: sqlalchemy.Index
+):
+    """
+    Rename index old_name on table_name to the name of idx. Not supported by SQLite.
+    """
+    q = conn.dialect.identifier_preparer.quote
+    if conn.dialect.name == "mssql":
+        conn.execute(
+            sqlalchemy.text("EXEC sp_rename :old, :new, 'INDEX'"),
+            {"old": f"{table_name}.{old_name}", "new": idx.name},
+        )
+    else:
+        conn.execute(
+            sqlalchemy.text(f"ALTER INDEX {q(old_name)} RENAME TO {q(idx.name)}")
+        )
+
+
+def insert_data_partitioned(
+    session: Session,
+    table_data: TableData,
+    partitions: int = 4,
+    method: str = "range",
+    chunk_size: int = 100000,
+    writer: str | Callable = "auto",
+) -> TableResult:
+    """
+    Replace all data in one large table by loading partitions of the dataframe concurrently.
+
+    The dataframe is split into partitions by primary key, either into contiguous key
+    ranges (method="range") or by key hash (method="hash"). Each partition is written
+    into a shared shadow table by its own thread, Session and pooled connection. Once all
+    partitions commit, indexes are built and the shadow table is swapped in as with
+    clear_tables_and_insert_data(swap=True). If any partition fails, the shadow table is
+    dropped and the existing table is left unchanged.
+
+    Primary key values are kept when the key is not generated by the DB, as for
+    PrwCharges. Otherwise the key column is dropped and rows are split by position.
+    table_data.df must be a DataFrame. SQLite serializes writers, so this only helps on
+    server databases.
+    """
+    table = table_data.table
+    df = table_data.df
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError(
+            "Partitioned load requires a DataFrame, not a stream of chunks"
+        )
+    if partitions < 1:
+        raise ValueError(f"partitions must be at least 1: {partitions}")
+
+    pk_col = table.__table__.primary_key.columns.keys()[0]
+    keep_pk = pk_col in df.columns and table.__table__.autoincrement_column is None
+    if keep_pk and df[pk_col].duplicated().any():
+        raise ValueError(f"Duplicate primary keys found in dataframe: {pk_col}")
+
+    logging.info(
+        f"Writing data to table: {table.__tablename__}, rows: {len(df)}, partitions: {partitions}"
+    )
+    start_time = time.time()
+    parts = _partition_df(df, pk_col if keep_pk else None, partitions, method)
+
+    def load_partition(part: pd.DataFrame) -> int:
+        with Session(session.bind) as part_session:
+            nrows = 0
+            part_data = TableData(table, part)
+            for chunk in _iter_prepared_chunks(
+                part_data, chunk_size, drop_pk=not keep_pk
+            ):
+                bulk_insert_df(
+                    part_session.connection(),
+                    shadow.name,
+                    chunk,
+                    chunk_size=chunk_size,
+                    writer=writer,
+                    metrics_name=table.__tablename__,
+                )
+                nrows += len(chunk)
+            with metrics_utils.stage(table.__tablename__, "commit"):
+                part_session.commit()
+            return nrows
+
+    shadow = _create_shadow_table(session, table)
+    try:
+        # An empty dataframe has no partitions, and swaps in the empty shadow table
+        with ThreadPoolExecutor(max_workers=max(1, len(parts))) as executor:
+            nrows = sum(executor.map(load_partition, parts))
+        _swap_in_shadow_table(session, table, shadow)
+    except Exception:
+        logging.error(f"ERROR: partitioned load failed, rolling back {shadow.name}")
+        _drop_shadow_table(session, table, shadow)
+        raise
+
+    elapsed_time = time.time() - start_time
+    logging.info(f"Wrote {nrows} rows to {table.__tablename__} in {elapsed_time:.2f}s")
+    return TableResult(table_name=table.__tablename__, rows=nrows, elapsed=elapsed_time)
+
+
+def _partition_df(
+    df: pd.DataFrame, key_col: str | None, partitions: int, method: str
+) -> List[pd.DataFrame]:
+    """
+    Split df into at most partitions non-empty dataframes by key_col value ranges or
+    hashes. Without a key_col, split by row position.
+    """
+    if key_col is None:
+        part_ids = np.arange(len(df)) * partitions // max(len(df), 1)
+    elif method == "range":
+        # Equal-sized ranges of the sorted keys
+        ranks = df[key_col].rank(method="first").to_numpy() - 1
+        part_ids = (ranks * partitions // max(len(df), 1)).astype(np.int64)
+    elif method == "hash":
+        hashes = pd.util.hash_pandas_object(df[key_col], index=False).to_numpy()
+        part_ids = hashes % np.uint64(partitions)
+    else:
+        raise ValueError(f"Unknown partition method: {method}")
+
+    return [part for _, part in df.groupby(part_ids, sort=True)]
+
+
+def replace_partitions(
+    session: Session,
+    table_data: TableData,
+    partition_col: str = "month",
+    chunk_size: int = 100000,
+    writer: str | Callable = "auto",
+) -> TableResult:
+    """
+    Replace only the partitions of a table present in the dataframe: delete existing rows
+    whose partition_col value appears in table_data.df, then insert table_data.df, in one
+    transaction. Other partitions are left unchanged. For example, refresh the latest
+    months of a PrwFinanceModel table after a month close without reloading its history.
+
+    Indexes on partition_col defined by the model are created first if missing, so
+    the delete does not scan the table. Primary keys are generated by the DB, or kept
+    from table_data when the key is not generated by the DB.
+    """
+    table = table_data.table
+    df = table_data.df
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError(
+            "Partition replace requires a DataFrame, not a stream of chunks"
+        )
+    if partition_col not in df.columns:
+        raise ValueError(f"Partition column not found in dataframe: {partition_col}")
+    if df[partition_col].isna().any():
+        raise ValueError(f"Missing values found in partition column: {partition_col}")
+
+    partitions = [_to_db_value(value) for value in df[partition_col].unique()]
+    logging.info(
+        f"Replacing partitions of table: {table.__tablename__}, rows: {len(df)}, {partition_col}: {', '.join(map(str, sorted(partitions)))}"
+    )
+    start_time = time.time()
+    try:
+        conn = session.connection()
+        for index in table.__table__.indexes:
+            if partition_col in index.columns:
+                index.create(conn, checkfirst=True)
+
+        _drop_digest_table(session, table)
+
+        with metrics_utils.stage(table.__tablename__, "clear"):
+            _delete_in_batches(session, table, partition_col, partitions)
+
+        nrows = 0
+        drop_pk = table.__table__.autoincrement_column is not None
+        for chunk in _iter_prepared_chunks(table_data, chunk_size, drop_pk=drop_pk):
+            bulk_insert_df(
+                session.connection(),
+                table.__tablename__,
+                chunk,
+                chunk_size=chunk_size,
+                writer=writer,
+            )
+            nrows += len(chunk)
+        with metrics_utils.stage(table.__tablename__, "commit"):
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    elapsed_time = time.time() - start_time
+    logging.info(
+        f"Wrote {nrows} rows to {len(partitions)} partitions of {table.__tablename__} in {elapsed_time:.2f}s"
+    )
+    return TableResult(table_name=table.__tablename__, rows=nrows, elapsed=elapsed_time)
+
+
+def _delete_in_batches(
+    session: Session, table: SQLModel, col: str, values: list, batch_size: int = 1000
+) -> int:
+    """
+    Delete rows of table where col is in values, batch_size values per statement to stay
+    under parameter limits, e.g. 2100 for MSSQL. Returns the number of rows deleted.
+    """
+    column = getattr(table, col)
+    deleted = 0
+    for i in range(0, len(values), batch_size):
+        result = session.exec(
+            delete(table).where(column.in_(values[i : i + batch_size]))
+        )
+        deleted += result.rowcount
+    return deleted
+
+
+def write_incremental(
+    session: Session,
+    table_data: TableData,
+    source: str,
+    watermark_col: str,
+    watermark_table: SQLModel,
+    method: str = "window",
+    chunk_size: int = 100000,
+    writer: str | Callable = "auto",
+) -> TableResult:
+    """
+    Apply an incremental extract of new and changed rows to a table and advance the
+    source's high-watermark, the largest watermark_col value loaded so far, in
+    watermark_table (e.g. PrwSourcesWatermark).
+
+    The extract step should call get_watermark() and pull only rows where watermark_col
+    >= the returned value, or all rows if it is None. Rows at the watermark itself are
+    pulled again, so rows that arrived late with the same timestamp are not missed.
+
+    method="window" deletes existing rows where watermark_col >= the smallest incoming
+    value, then inserts table_data, all in one transaction. If the primary key is not
+    generated by the DB, as for PrwCharges, keys are kept from table_data, and existing
+    rows with the same keys as incoming rows are deleted too, so changed rows whose
+    stored watermark_col is older than the window are replaced. If the key is generated
+    by the DB, incoming rows cannot be matched to existing ones, so use method="upsert"
+    when changed rows can move into the window. Suited to append-mostly tables keyed by
+    a date, like PrwCharges.post_date.
+    method="upsert" updates and inserts by primary key with upsert_data().
+
+    The watermark is only advanced after the data is written, so a failed run is
+    retried from the previous watermark.
+    """
+    table = table_data.table
+    df = table_data.df
+    if not isinstance(df, pd.DataFrame):
+        raise ValueError(
+            "Incremental load requires a DataFrame, not a stream of chunks"
+        )
+    if watermark_col not in df.columns:
+        raise ValueError(f"Watermark column not found in dataframe: {watermark_col}")
+
+    start_time = time.time()
+    values = df[watermark_col].dropna()
+    if values.empty:
+        logging.info(f"No new rows for {table.__tablename__} from {source}")
+        return TableResult(table_name=table.__tablename__)
+    logging.info(
+        f"Incremental load to table: {table.__tablename__}, rows: {len(df)}, {watermark_col} {values.min()} - {values.max()}"
+    )
+
+    if method == "window":
+        # Replace the window covered by the extract in a single transaction
+        window_start = _to_db_value(values.min())
+        _drop_digest_table(session, table)
+        with metrics_utils.stage(table.__tablename__, "clear"):
+            result = session.exec(
+                delete(table).where(getattr(table, watermark_col) >= window_start)
+            )
         logging.info(
-            f"Wrote {len(df)} rows to {table_data.table.__tablename__} in {elapsed_time:.2f}s"
+            f"Deleted {result.rowcount} rows from {watermark_col} {window_start}"
         )
 
+        # Also replace changed rows whose previous version is older than the window
+        pk_col = table.__table__.primary_key.columns.keys()[0]
+        drop_pk = table.__table__.autoincrement_column is not None
+        if not drop_pk and pk_col in df.columns:
+            pks = [_to_db_value(pk) for pk in df[pk_col].dropna().unique()]
+            with metrics_utils.stage(table.__tablename__, "clear"):
+                deleted = _delete_in_batches(session, table, pk_col, pks)
+            logging.info(f"Deleted {deleted} earlier versions of changed rows")
+        nrows = 0
+        for chunk in _iter_prepared_chunks(table_data, chunk_size, drop_pk=drop_pk):
+            bulk_insert_df(
+                session.connection(),
+                table.__tablename__,
+                chunk,
+                chunk_size=chunk_size,
+                writer=writer,
+            )
+            nrows += len(chunk)
+    elif method == "upsert":
+        nrows = upsert_data(session, [table_data], chunk_size, writer=writer)[0].rows
+    else:
+        raise ValueError(f"Unknown incremental load method: {method}")
 
-def upsert_data(
-    session: Session, tables_data: List[TableData], chunk_size: int = 100000
+    # Advance the watermark, never moving it backwards
+    watermark = _to_db_value(values.max())
+    previous = get_watermark(session, watermark_table, source)
+    if previous is not None and type(previous) is type(watermark):
+        watermark = max(watermark, previous)
+    set_watermark(session, watermark_table, source, watermark_col, watermark)
+    with metrics_utils.stage(table.__tablename__, "commit"):
+        session.commit()
+
+    elapsed_time = time.time() - start_time
+    logging.info(
+        f"Wrote {nrows} rows to {table.__tablename__} in {elapsed_time:.2f}s, watermark {watermark}"
+    )
+    return TableResult(table_name=table.__tablename__, rows=nrows, elapsed=elapsed_time)
+
+
+def get_watermark(
+    session: Session, watermark_table: SQLModel, source: str
+) -> datetime | int | str | None:
+    """
+    Return the high-watermark recorded for source by write_incremental(), or None if
+    nothing has been loaded yet
+    """
+    stmt = select(watermark_table).where(watermark_table.source == source)
+    row = session.exec(stmt).first()
+    if row is None:
+        return None
+    if row.watermark_type == "datetime":
+        return datetime.fromisoformat(row.watermark)
+    elif row.watermark_type == "int":
+        return int(row.watermark)
+    return row.watermark
+
+
+def set_watermark(
+    session: Session,
+    watermark_table: SQLModel,
+    source: str,
+    watermark_col: str,
+    watermark: datetime | int | str,
 ):
+    """
+    Record the high-watermark for source, replacing any previous value. Not committed.
+    """
+    if isinstance(watermark, datetime):
+        encoded, watermark_type = watermark.isoformat(), "datetime"
+    elif isinstance(watermark, (int, np.integer)):
+        encoded, watermark_type = str(int(watermark)), "int"
+    else:
+        encoded, watermark_type = str(watermark), "str"
+
+    stmt = select(watermark_table).where(watermark_table.source == source)
+    row = session.exec(stmt).first() or watermark_table(source=source)
+    row.watermark_col = watermark_col
+    row.watermark = encoded
+    row.watermark_type = watermark_type
+    row.modified = datetime.now()
+    session.add(row)
+
+
+def _to_db_value(value):
+    """
+    Convert a pandas/numpy scalar to the equivalent Python value for use in a query
+    """
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def upsert_data(
+    session: Session,
+    tables_data: List[TableData],
+    chunk_size: int = 100000,
+    server_side: bool = True,
+    writer: str | Callable = "auto",
+    max_workers: int = 1,
+    skip_unchanged: bool = False,
+    raise_on_error: bool = True,
+) -> List[TableResult]:
     """
     Write data from dataframes to DB tables, updating existing rows and inserting new ones.
-    Uses to_sql for inserts and bulk_update_mappings for updates.
+
+    With server_side=True (default), each chunk is loaded into a staging table and applied
+    with a single MERGE (MSSQL) or INSERT ... ON CONFLICT DO UPDATE (SQLite, Postgres)
+    statement, so existing primary keys are never read into memory. Other dialects, or
+    server_side=False, insert new rows and use bulk_update_mappings for updates.
+
+    With skip_unchanged=True, a hash of each row is compared to the hash recorded when
+    the row was last upserted, in a side table <table>_digest, and only new or changed
+    rows are written. Results include inserted, updated and unchanged counts. The side
+    table is dropped by the other functions in this module that replace or update rows,
+    including upserts without skip_unchanged. If the table is modified outside this
+    module, call drop_row_digests() so all rows are written on the next run.
+
+    writer selects the bulk insert backend, see bulk_insert_df(). max_workers > 1 writes
+    tables concurrently, and raise_on_error=False returns each table's error in its
+    result instead of raising, see _write_tables().
     """
-    for table_data in tables_data:
+
+    def write_table(session: Session, table_data: TableData) -> int:
         logging.info(
-            f"Upserting data to table: {table_data.table.__tablename__}, rows: {len(table_data.df)}"
+            f"Upserting data to table: {table_data.table.__tablename__}, rows: {_describe_len(table_data.df)}"
         )
 
-        # Prepare dataframe for DB by keeping shared columns and converting dtypes
-        df = _prepare_df_for_insert(table_data)
-
         # Get primary key column
         pk_col = table_data.table.__table__.primary_key.columns.keys()[0]
 
+        # Make sure there are no duplicate primary keys in the dataframe. When streaming
+        # chunks, duplicates can only be detected within each chunk.
+        if (
+            isinstance(table_data.df, pd.DataFrame)
+            and table_data.df[pk_col].duplicated().any()
+        ):
+            raise ValueError(f"Duplicate primary keys found in dataframe: {pk_col}")
+
+        # Prepare each chunk for DB by keeping shared columns and converting dtypes
+        chunks = _iter_prepared_chunks(table_data, chunk_size)
+        pk_range = _get_pk_range(table_data, pk_col)
+
+        # Drop rows with the same digest as when they were last written. Otherwise, the
+        # recorded digests will not match the written rows, so discard them.
+        if not skip_unchanged:
+            drop_row_digests(session, table_data.table)
+        else:
+            existing_digests = _load_row_digests(
+                session, table_data.table, pk_col, pk_range, chunk_size
+            )
+            changed_digests, counts = [], {"unchanged": 0}
+            chunks = _filter_unchanged_rows(
+                chunks, pk_col, existing_digests, changed_digests, counts
+            )
+            count_stmt = select(sqlalchemy.func.count()).select_from(table_data.table)
+            nrows_before = session.exec(count_stmt).one()
+
         # Write data from dataframe
         start_time = time.time()
         logging.info(f"Upserting table: {table_data.table.__tablename__}")
 
-        # Get all existing primary key values
-        existing_pks = session.exec(select(getattr(table_data.table, pk_col))).all()
+        dialect = session.bind.dialect.name
+        if server_side and dialect in _SERVER_UPSERT_DIALECTS:
+            nrows = _upsert_server_side(
+                session, table_data.table, chunks, pk_col, chunk_size, writer
+            )
+        else:
+            nrows = _upsert_client_side(
+                session,
+                table_data.table,
+                chunks,
+                pk_col,
+                chunk_size,
+                writer,
+                pk_range=pk_range,
+            )
+
+        elapsed_time = time.time() - start_time
+        logging.info(
+            f"Upserted {nrows} rows to {table_data.table.__tablename__} in {elapsed_time:.2f}s"
+        )
+        if not skip_unchanged:
+            return nrows
 
-        # Make sure there are no duplicate primary keys in the dataframe
-        if df[pk_col].duplicated().any():
-            raise ValueError(f"Duplicate primary keys found in dataframe: {pk_col}")
+        # Record digests of the written rows once they are committed
+        _save_row_digests(
+            session, table_data.table, pk_col, existing_digests, changed_digests
+        )
+        inserted = session.exec(count_stmt).one() - nrows_before
+        result = TableResult(
+            table_name=table_data.table.__tablename__,
+            rows=nrows,
+            inserted=inserted,
+            updated=nrows - inserted,
+            unchanged=counts["unchanged"],
+        )
+        logging.info(
+            f"{result.table_name}: {result.inserted} inserted, {result.updated} updated, {result.unchanged} unchanged"
+        )
+        return result
+
+    return _write_tables(session, tables_data, write_table, max_workers, raise_on_error)
 
-        # Process in chunks to avoid memory issues
-        for i in range(0, len(df), chunk_size):
-            logging.info(f"Writing rows {i+1}-{i + chunk_size}/{len(df)}")
-            chunk = df.iloc[i : i + chunk_size]
-
-            # Split into inserts and updates
-            to_insert = chunk[~chunk[pk_col].isin(existing_pks)]
-            to_update = chunk[chunk[pk_col].isin(existing_pks)]
-
-            # Insert new records using pandas
-            if not to_insert.empty:
-                to_insert.to_sql(
-                    name=table_data.table.__tablename__,
-                    con=session.connection(),
-                    if_exists="append",
-                    index=False,
-                )
 
-            # Bulk update existing records with sqlalchemy
-            if not to_update.empty:
-                session.bulk_update_mappings(
-                    table_data.table, to_update.to_dict("records")
+def _write_tables(
+    session: Session,
+    tables_data: List[TableData],
+    write_table: Callable[[Session, TableData], int | TableResult],
+    max_workers: int = 1,
+    raise_on_error: bool = True,
+) -> List[TableResult]:
+    """
+    Call write_table(session, table_data) for each table and return a TableResult per table.
+    write_table returns the number of rows written, or a TableResult with more detail.
+
+    With max_workers=1, tables are written in order on session and the first error is raised.
+    With max_workers > 1, up to max_workers tables are written at once, each in a new
+    Session with its own pooled connection and transaction. All tables are attempted, then
+    a RuntimeError is raised if any failed. Keep max_workers within the engine's pool
+    size and the DB's capacity. SQLite allows only one writer at a time, so use 1 there.
+
+    With raise_on_error=False, all tables are attempted in either mode and nothing is
+    raised. Check TableResult.error of each result for failed tables.
+    """
+
+    def run(session: Session, table_data: TableData) -> TableResult:
+        result = TableResult(table_name=table_data.table.__tablename__)
+        start_time = time.time()
+        try:
+            written = write_table(session, table_data)
+            if isinstance(written, TableResult):
+                result = written
+            else:
+                result.rows = written
+        except Exception as e:
+            # Discard the failed table's uncommitted writes before the next table
+            session.rollback()
+            result.error = e
+        result.elapsed = time.time() - start_time
+        return result
+
+    def run_in_new_session(table_data: TableData) -> TableResult:
+        with Session(session.bind) as worker_session:
+            return run(worker_session, table_data)
+
+    if max_workers <= 1:
+        results = []
+        for table_data in tables_data:
+            result = run(session, table_data)
+            if result.error is not None and raise_on_error:
+                raise result.error
+            results.append(result)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(run_in_new_session, tables_data))
+
+    failed = [result for result in results if result.error is not None]
+    for result in results:
+        if result.error is None:
+            logging.info(
+                f"{result.table_name}: {result.rows} rows in {result.elapsed:.2f}s"
+            )
+        else:
+            logging.error(f"ERROR: {result.table_name} failed: {result.error}")
+    if failed and raise_on_error:
+        raise RuntimeError(
+            f"Failed to write tables: {', '.join(r.table_name for r in failed)}"
+        ) from failed[0].error
+    return results
+
+
+# Dialects that support a single-statement upsert from a staging table
+_SERVER_UPSERT_DIALECTS = ("mssql", "sqlite", "postgresql")
+
+
+def _upsert_client_side(
+    session: Session,
+    table: SQLModel,
+    chunks: Iterable[pd.DataFrame],
+    pk_col: str,
+    chunk_size: int,
+    writer: str | Callable,
+    pk_range: tuple[int, int] = None,
+) -> int:
+    """
+    Upsert by reading existing primary keys from the DB and splitting each chunk into
+    inserts (bulk_insert_df) and updates (bulk_update_mappings). Returns the number of
+    rows written.
+
+    If pk_range is given as (min, max) of the incoming integer keys, only existing keys
+    in that range are read.
+    """
+    existing_pks = _load_existing_pks(session, table, pk_col, pk_range, chunk_size)
+
+    nrows = 0
+    for chunk in chunks:
+        logging.info(f"Writing rows {nrows + 1}-{nrows + len(chunk)}")
+        _check_chunk_pks(chunk, pk_col)
+
+        # Split into inserts and updates
+        exists = existing_pks.contains(chunk[pk_col])
+        to_insert = chunk[~exists]
+        to_update = chunk[exists]
+
+        # Insert new records
+        if not to_insert.empty:
+            bulk_insert_df(
+                session.connection(),
+                table.__tablename__,
+                to_insert,
+                chunk_size=chunk_size,
+                writer=writer,
+            )
+
+        # Bulk update existing records with sqlalchemy
+        if not to_update.empty:
+            with metrics_utils.stage(
+                table.__tablename__, "update", rows=len(to_update)
+            ):
+                # Convert NaN / NaT / NA to None, which drivers accept as NULL
+                columns = list(to_update.columns)
+                mappings = [dict(zip(columns, row)) for row in _df_to_rows(to_update)]
+                session.bulk_update_mappings(table, mappings)
+
+        # Commit each chunk
+        with metrics_utils.stage(table.__tablename__, "commit"):
+            session.commit()
+        nrows += len(chunk)
+    return nrows
+
+
+class _KeySet:
+    """
+    Set of primary keys for vectorized membership tests. Integer keys are held in a
+    sorted int64 array and looked up with searchsorted. Other keys are held in a pandas
+    Index, whose hash table is built once on the first lookup.
+    """
+
+    def __init__(self, keys: np.ndarray):
+        if keys.dtype == np.int64:
+            keys.sort()
+            self.keys = keys
+        else:
+            self.keys = pd.Index(keys)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def contains(self, values: pd.Series) -> np.ndarray:
+        """
+        Boolean array of whether each value is in the set
+        """
+        if isinstance(self.keys, pd.Index):
+            return self.keys.get_indexer(values.to_numpy()) >= 0
+        if len(self.keys) == 0 or values.isna().any():
+            return values.isin(self.keys).to_numpy()
+        values = values.to_numpy(np.int64)
+        pos = np.searchsorted(self.keys, values)
+        pos[pos == len(self.keys)] = 0
+        return self.keys[pos] == values
+
+
+def _load_existing_pks(
+    session: Session,
+    table: SQLModel,
+    pk_col: str,
+    pk_range: tuple[int, int] = None,
+    batch_size: int = 100000,
+) -> _KeySet:
+    """
+    Read the primary keys of table, restricted to pk_range if given, in batches of
+    batch_size into a _KeySet
+    """
+    pk = table.__table__.columns[pk_col]
+    is_int = _get_dtype_plan(table)[pk_col] == "int"
+    stmt = sqlalchemy.select(pk)
+    if pk_range is not None:
+        stmt = stmt.where(pk.between(*pk_range))
+
+    start_time = time.time()
+    result = session.connection().execute(
+        stmt, execution_options={"yield_per": batch_size}
+    )
+    batches = [
+        np.array(batch, dtype=np.int64 if is_int else object)
+        for batch in result.scalars().partitions()
+    ]
+    keys = np.concatenate(batches) if batches else np.array([], dtype=np.int64)
+    existing_pks = _KeySet(keys)
+    metrics_utils.record(
+        table.__tablename__,
+        "read_keys",
+        time.time() - start_time,
+        rows=len(existing_pks),
+    )
+    logging.info(f"Read {len(existing_pks)} existing keys from {table.__tablename__}")
+    return existing_pks
+
+
+def _get_pk_range(table_data: TableData, pk_col: str) -> tuple[int, int] | None:
+    """
+    (min, max) of the integer primary keys in table_data, or None if not known up front
+    because the key is not an integer, or the data is streamed
+    """
+    df = table_data.df
+    if (
+        not isinstance(df, pd.DataFrame)
+        or pk_col not in df.columns
+        or _get_dtype_plan(table_data.table)[pk_col] != "int"
+    ):
+        return None
+    pks = pd.to_numeric(df[pk_col], errors="coerce")
+    if pks.empty or pks.isna().any():
+        return None
+    return int(pks.min()), int(pks.max())
+
+
+def _upsert_server_side(
+    session: Session,
+    table: SQLModel,
+    chunks: Iterable[pd.DataFrame],
+    pk_col: str,
+    chunk_size: int,
+    writer: str | Callable,
+) -> int:
+    """
+    Upsert by loading each chunk into a staging table and merging it into the target
+    table with one statement per chunk. Returns the number of rows written.
+    """
+    staging = None
+    nrows = 0
+    try:
+        for chunk in chunks:
+            logging.info(f"Writing rows {nrows + 1}-{nrows + len(chunk)}")
+            _check_chunk_pks(chunk, pk_col)
+
+            # Create staging table using the columns of the first chunk
+            conn = session.connection()
+            if staging is None:
+                columns = list(chunk.columns)
+                staging = _create_staging_table(conn, table, columns)
+                upsert_stmt = _build_upsert_from_staging(
+                    conn, table, staging, columns, pk_col
                 )
 
+            conn.execute(sqlalchemy.delete(staging))
+            bulk_insert_df(
+                conn,
+                staging.name,
+                chunk,
+                chunk_size=chunk_size,
+                writer=writer,
+                metrics_name=table.__tablename__,
+            )
+            with metrics_utils.stage(table.__tablename__, "merge", rows=len(chunk)):
+                conn.execute(upsert_stmt)
+
             # Commit each chunk
+            with metrics_utils.stage(table.__tablename__, "commit"):
+                session.commit()
+            nrows += len(chunk)
+    finally:
+        session.rollback()
+        if staging is not None:
+            staging.drop(session.connection(), checkfirst=True)
             session.commit()
+    return nrows
 
-        elapsed_time = time.time() - start_time
-        logging.info(
-            f"Upserted {len(df)} rows to {table_data.table.__tablename__} in {elapsed_time:.2f}s"
+
+def drop_row_digests(session: Session, table: SQLModel):
+    """
+    Forget the row digests recorded by upsert_data(skip_unchanged=True), so the next
+    upsert writes every row
+    """
+    _drop_digest_table(session, table)
+    session.commit()
+
+
+def _get_digest_table(table: SQLModel) -> sqlalchemy.Table:
+    """
+    Side table of primary key -> row digest for table
+    """
+    pk = table.__table__.primary_key.columns.values()[0]
+    return sqlalchemy.Table(
+        f"{table.__tablename__}_digest",
+        sqlalchemy.MetaData(),
+        sqlalchemy.Column(pk.name, pk.type, primary_key=True, autoincrement=False),
+        sqlalchemy.Column("digest", sqlalchemy.BigInteger, nullable=False),
+    )
+
+
+def _drop_digest_table(session: Session, table: SQLModel):
+    _get_digest_table(table).drop(session.connection(), checkfirst=True)
+
+
+def _load_row_digests(
+    session: Session,
+    table: SQLModel,
+    pk_col: str,
+    pk_range: tuple[int, int] = None,
+    batch_size: int = 100000,
+) -> pd.Series:
+    """
+    Return the recorded digest of each row as a Series indexed by primary key, restricted
+    to keys in pk_range if given. Rows are read in batches of batch_size into arrays.
+    """
+    digest_table = _get_digest_table(table)
+    conn = session.connection()
+    digest_table.create(conn, checkfirst=True)
+    stmt = sqlalchemy.select(digest_table.c[pk_col], digest_table.c.digest)
+    if pk_range is not None:
+        stmt = stmt.where(digest_table.c[pk_col].between(*pk_range))
+
+    key_dtype = np.int64 if _get_dtype_plan(table)[pk_col] == "int" else object
+    keys, digests = [np.array([], dtype=key_dtype)], [np.array([], dtype=np.int64)]
+    result = conn.execute(stmt, execution_options={"yield_per": batch_size})
+    for batch in result.partitions():
+        batch_keys, batch_digests = zip(*batch)
+        keys.append(np.array(batch_keys, dtype=key_dtype))
+        digests.append(np.array(batch_digests, dtype=np.int64))
+    return pd.Series(np.concatenate(digests), index=np.concatenate(keys))
+
+
+def _hash_rows(chunk: pd.DataFrame) -> np.ndarray:
+    """
+    Vectorized 64-bit hash of each row's values, as signed integers to fit a BigInteger
+    """
+    return pd.util.hash_pandas_object(chunk, index=False).to_numpy().view(np.int64)
+
+
+def _filter_unchanged_rows(
+    chunks: Iterable[pd.DataFrame],
+    pk_col: str,
+    existing_digests: pd.Series,
+    changed_digests: List[pd.Series],
+    counts: dict,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield only the rows of each chunk whose digest differs from existing_digests.
+    Appends the digests of yielded rows to changed_digests and counts skipped rows.
+    """
+    for chunk in chunks:
+        digests = _hash_rows(chunk)
+        previous = existing_digests.reindex(chunk[pk_col].to_numpy()).to_numpy()
+        changed = previous != digests
+        counts["unchanged"] += int((~changed).sum())
+        if changed.any():
+            chunk = chunk[changed]
+            changed_digests.append(
+                pd.Series(digests[changed], index=chunk[pk_col].to_numpy())
+            )
+            yield chunk
+
+
+def _save_row_digests(
+    session: Session,
+    table: SQLModel,
+    pk_col: str,
+    existing_digests: pd.Series,
+    changed_digests: List[pd.Series],
+):
+    """
+    Replace the recorded digests of written rows and commit
+    """
+    if not changed_digests:
+        return
+    digests = pd.concat(changed_digests)
+    digest_table = _get_digest_table(table)
+    conn = session.connection()
+    with metrics_utils.stage(table.__tablename__, "digest", rows=len(digests)):
+        # Delete previous digests of updated rows in batches to stay under parameter limits
+        stale = digests.index[digests.index.isin(existing_digests.index)].tolist()
+        pk = digest_table.c[pk_col]
+        for i in range(0, len(stale), 1000):
+            conn.execute(
+                sqlalchemy.delete(digest_table).where(pk.in_(stale[i : i + 1000]))
+            )
+        df = pd.DataFrame({pk_col: digests.index, "digest": digests.to_numpy()})
+        bulk_insert_df(conn, digest_table.name, df, metrics_name=table.__tablename__)
+        session.commit()
+
+
+def _check_chunk_pks(chunk: pd.DataFrame, pk_col: str):
+    """
+    Raise ValueError if chunk is missing the primary key column or has duplicate keys
+    """
+    if pk_col not in chunk.columns:
+        raise ValueError(f"Primary key column not found in dataframe: {pk_col}")
+    if chunk[pk_col].duplicated().any():
+        raise ValueError(f"Duplicate primary keys found in dataframe: {pk_col}")
+
+
+def _create_staging_table(
+    conn: sqlalchemy.Connection,
+    table: SQLModel,
+    columns: List[str],
+    suffix: str = "staging",
+) -> sqlalchemy.Table:
+    """
+    Create an empty table with the given columns of table, but without any keys,
+    constraints or indexes. Replaces any existing table of the same name.
+    """
+    staging = sqlalchemy.Table(
+        f"{table.__tablename__}_{suffix}",
+        sqlalchemy.MetaData(),
+        *[
+            sqlalchemy.Column(col.name, col.type)
+            for col in table.__table__.columns
+            if col.name in columns
+        ],
+    )
+    staging.drop(conn, checkfirst=True)
+    staging.create(conn)
+    return staging
+
+
+def _build_upsert_from_staging(
+    conn: sqlalchemy.Connection,
+    table: SQLModel,
+    staging: sqlalchemy.Table,
+    columns: List[str],
+    pk_col: str,
+) -> sqlalchemy.Executable:
+    """
+    Return a statement that upserts all rows from staging into table for the
+    connection's dialect
+    """
+    target = table.__table__
+    update_cols = [col for col in columns if col != pk_col]
+    dialect = conn.dialect.name
+
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+
+        # SQLite requires a WHERE clause on INSERT ... SELECT to parse ON CONFLICT
+        src = sqlalchemy.select(*[staging.c[col] for col in columns]).where(
+            sqlalchemy.true()
+        )
+        stmt = insert(target).from_select(columns, src)
+        if update_cols:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[pk_col],
+                set_={col: stmt.excluded[col] for col in update_cols},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[pk_col])
+        return stmt
+
+    if dialect == "mssql":
+        q = conn.dialect.identifier_preparer.quote
+        target_name = conn.dialect.identifier_preparer.format_table(target)
+        sql = (
+            f"MERGE INTO {target_name} WITH (HOLDLOCK) AS tgt "
+            f"USING {q(staging.name)} AS src ON tgt.{q(pk_col)} = src.{q(pk_col)} "
         )
+        if update_cols:
+            set_clause = ", ".join(
+                f"tgt.{q(col)} = src.{q(col)}" for col in update_cols
+            )
+            sql += f"WHEN MATCHED THEN UPDATE SET {set_clause} "
+        col_list = ", ".join(q(col) for col in columns)
+        src_list = ", ".join(f"src.{q(col)}" for col in columns)
+        sql += f"WHEN NOT MATCHED THEN INSERT ({col_list}) VALUES ({src_list});"
+
+        # Explicit values for an IDENTITY PK must be enabled for the duration of the MERGE
+        if target.autoincrement_column is not None:
+            sql = (
+                f"SET IDENTITY_INSERT {target_name} ON; "
+                f"{sql} "
+                f"SET IDENTITY_INSERT {target_name} OFF;"
+            )
+        return sqlalchemy.text(sql)
+
+    raise ValueError(f"Server-side upsert not supported for dialect: {dialect}")
+
+
+def bulk_insert_df(
+    conn: sqlalchemy.Connection,
+    table_name: str,
+    df: pd.DataFrame,
+    chunk_size: int = 100000,
+    writer: str | Callable = "auto",
+    metrics_name: str = None,
+):
+    """
+    Append all rows in df to a table using a bulk insert backend.
+
+    Args:
+        conn: connection to write with. Rows are written in the connection's current
+            transaction and are not committed.
+        table_name: name of the table. Column names must match df. If the table does
+            not exist, it is created by pandas to_sql() whatever the writer.
+        chunk_size: max number of rows to send to the DB at once
+        writer: name of a backend in BULK_WRITERS, "auto" to pick the fastest backend
+            for the connection's dialect, or a callable with the same signature as the
+            functions in BULK_WRITERS.
+        metrics_name: name to record the write under in metrics_utils, if different
+            from table_name, such as when writing to a staging table.
+    """
+    if df.empty:
+        return
+    if writer == "auto":
+        writer = _DEFAULT_BULK_WRITERS.get(conn.dialect.name, "pandas")
+    if isinstance(writer, str):
+        if writer not in BULK_WRITERS:
+            raise ValueError(f"Unknown bulk writer: {writer}")
+        writer = BULK_WRITERS[writer]
+    if writer is not _write_pandas and not inspect(conn).has_table(table_name):
+        # Only to_sql() creates a missing table, from the dataframe's dtypes
+        logging.info(f"Table {table_name} not found, writing with pandas")
+        writer = _write_pandas
+    with metrics_utils.stage(metrics_name or table_name, "write", rows=len(df)):
+        writer(conn, table_name, df, chunk_size)
+
+
+def _write_pandas(
+    conn: sqlalchemy.Connection, table_name: str, df: pd.DataFrame, chunk_size: int
+):
+    """
+    Insert using pandas to_sql(). Works with any dialect. MSSQL connections created by
+    get_db_connection() use pyodbc fast_executemany.
+    """
+    df.to_sql(
+        name=table_name,
+        con=conn,
+        if_exists="append",
+        index=False,
+        chunksize=chunk_size,
+    )
+
+
+def _write_sqlite(
+    conn: sqlalchemy.Connection, table_name: str, df: pd.DataFrame, chunk_size: int
+):
+    """
+    Insert using a single prepared INSERT executed over row tuples
+    """
+    q = conn.dialect.identifier_preparer.quote
+    cols = ", ".join(q(col) for col in df.columns)
+    params = ", ".join("?" for _ in df.columns)
+    sql = f"INSERT INTO {q(table_name)} ({cols}) VALUES ({params})"
+
+    # Store datetimes in the same text format as SQLAlchemy's SQLite DateTime type
+    for i in range(0, len(df), chunk_size):
+        rows = _df_to_rows(
+            df.iloc[i : i + chunk_size], datetime_format="%Y-%m-%d %H:%M:%S.%f"
+        )
+        conn.exec_driver_sql(sql, rows)
+
+
+def _write_postgresql_copy(
+    conn: sqlalchemy.Connection, table_name: str, df: pd.DataFrame, chunk_size: int
+):
+    """
+    Insert using COPY FROM STDIN with CSV data from an in-memory buffer. Supports
+    psycopg2 and psycopg (3) drivers.
+    """
+    q = conn.dialect.identifier_preparer.quote
+    cols = ", ".join(q(col) for col in df.columns)
+    sql = f"COPY {q(table_name)} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        for i in range(0, len(df), chunk_size):
+            buf = io.StringIO()
+            df.iloc[i : i + chunk_size].to_csv(
+                buf, index=False, header=False, na_rep="\\N"
+            )
+            buf.seek(0)
+            if hasattr(cursor, "copy_expert"):
+                # psycopg2
+                cursor.copy_expert(sql, buf)
+            else:
+                # psycopg 3
+                with cursor.copy(sql) as copy:
+                    copy.write(buf.getvalue())
+    finally:
+        cursor.close()
+
+
+# SQL Server limits a statement to 2100 parameters and a VALUES clause to 1000 rows
+_MSSQL_MAX_PARAMS = 2100
+_MSSQL_MAX_VALUES_ROWS = 1000
+
+
+def _write_mssql_values(
+    conn: sqlalchemy.Connection, table_name: str, df: pd.DataFrame, chunk_size: int
+):
+    """
+    Insert using multi-row INSERT ... VALUES statements, sized to stay under SQL Server's
+    parameter and row limits
+    """
+    q = conn.dialect.identifier_preparer.quote
+    cols = ", ".join(q(col) for col in df.columns)
+    row_params = "(" + ", ".join("?" for _ in df.columns) + ")"
+    batch_rows = max(
+        1, min(_MSSQL_MAX_VALUES_ROWS, (_MSSQL_MAX_PARAMS - 1) // len(df.columns))
+    )
+
+    def insert_sql(nrows: int) -> str:
+        values = ", ".join(row_params for _ in range(nrows))
+        return f"INSERT INTO {q(table_name)} ({cols}) VALUES {values}"
+
+    # Reuse the same statement text for every full batch so the server can cache the plan
+    full_batch_sql = insert_sql(batch_rows)
+    for i in range(0, len(df), chunk_size):
+        rows = _df_to_rows(df.iloc[i : i + chunk_size])
+        for j in range(0, len(rows), batch_rows):
+            batch = rows[j : j + batch_rows]
+            sql = full_batch_sql if len(batch) == batch_rows else insert_sql(len(batch))
+            conn.exec_driver_sql(sql, tuple(v for row in batch for v in row))
+
+
+def _df_to_rows(df: pd.DataFrame, datetime_format: str = None) -> List[tuple]:
+    """
+    Convert a dataframe to a list of row tuples of python values that DBAPI drivers
+    accept, with None for missing values. If datetime_format is given, datetime columns
+    are converted to strings in that format.
+    """
+    rows_df = df.astype(object)
+    if datetime_format:
+        for col in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                rows_df[col] = df[col].dt.strftime(datetime_format)
+    rows_df = rows_df.where(rows_df.notna(), None)
+    return list(rows_df.itertuples(index=False, name=None))
+
+
+# Available bulk insert backends, see bulk_insert_df()
+BULK_WRITERS = {
+    "pandas": _write_pandas,
+    "sqlite": _write_sqlite,
+    "postgresql_copy": _write_postgresql_copy,
+    "mssql_values": _write_mssql_values,
+}
+
+# Backend used by writer="auto" for each dialect. Other dialects use pandas to_sql().
+_DEFAULT_BULK_WRITERS = {
+    "sqlite": "sqlite",
+    "postgresql": "postgresql_copy",
+}
+
+
+def _describe_len(df: pd.DataFrame | Iterable[pd.DataFrame]) -> str:
+    """
+    Row count for logging, which is unknown until a stream of chunks is consumed
+    """
+    return str(len(df)) if isinstance(df, pd.DataFrame) else "streamed"
+
+
+def _iter_prepared_chunks(
+    table_data: TableData, chunk_size: int, drop_pk: bool = False
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield the data in table_data as chunks of at most chunk_size rows, each prepared for
+    insert by _prepare_df_for_insert(). Only one chunk is converted at a time, so memory
+    is bounded by chunk_size rather than the size of the table.
+    """
+    pk_col = table_data.table.__table__.primary_key.columns.keys()[0]
+    dfs = [table_data.df] if isinstance(table_data.df, pd.DataFrame) else table_data.df
+    nrows, elapsed_time = 0, 0.0
+    for df in dfs:
+        for i in range(0, len(df), chunk_size):
+            start_time = time.time()
+            chunk_data = TableData(table_data.table, df.iloc[i : i + chunk_size])
+            chunk = _prepare_df_for_insert(chunk_data)
+            if drop_pk and pk_col in chunk.columns:
+                chunk = chunk.drop(columns=[pk_col])
+            chunk_time = time.time() - start_time
+            metrics_utils.record(
+                table_data.table.__tablename__, "convert", chunk_time, rows=len(chunk)
+            )
+            elapsed_time += chunk_time
+            nrows += len(chunk)
+            yield chunk
+
+    logging.info(
+        f"Converted dtypes of {nrows} rows for {table_data.table.__tablename__} in {elapsed_time:.2f}s"
+    )
 
 
 def _prepare_df_for_insert(table_data: TableData) -> pd.DataFrame:
@@ -205,47 +1626,191 @@ def _prepare_df_for_insert(table_data: TableData) -> pd.DataFrame:
     table_columns = [col for col in table_columns if col in table_data.df.columns]
 
     # Convert dataframe datatypes to match DB types
-    df = _convert_df_dtypes_to_db(table_data, table_columns)
+    return _convert_df_dtypes_to_db(table_data, table_columns)
+
+
+@functools.cache
+def _get_dtype_plan(table: SQLModel) -> dict[str, str]:
+    """
+    Map each column in table to the kind of pandas dtype used to write it: one of
+    "string", "int", "float", "datetime", "bool" or "object". Cached per table class.
+    """
+    plan = {}
+    for sa_column in table.__table__.columns:
+        # Use the underlying type of wrappers like SQLModel's AutoString
+        sa_type = sa_column.type
+        if isinstance(sa_type, sqlalchemy.TypeDecorator):
+            sa_type = sa_type.impl
+        if isinstance(sa_type, sqlalchemy.String):
+            plan[sa_column.name] = "string"
+        elif isinstance(sa_type, sqlalchemy.Integer):
+            plan[sa_column.name] = "int"
+        elif isinstance(sa_type, sqlalchemy.Float):
+            plan[sa_column.name] = "float"
+        elif isinstance(sa_type, (sqlalchemy.DateTime, sqlalchemy.Date)):
+            plan[sa_column.name] = "datetime"
+        elif isinstance(sa_type, sqlalchemy.Boolean):
+            plan[sa_column.name] = "bool"
+        else:
+            plan[sa_column.name] = "object"
+    return plan
+
 
-    return df[table_columns]
+def _get_target_dtype(kind: str, series: pd.Series) -> str | None:
+    """
+    Return the dtype to convert series to for a column of the given kind, or None if
+    the current dtype can already be written as is. Only non-conforming columns are
+    scanned for missing values.
+    """
+    dtype = series.dtype
+    if kind == "string":
+        # Arrow-backed or python string dtypes are kept to avoid object conversion
+        if pd.api.types.is_object_dtype(dtype) or isinstance(dtype, pd.StringDtype):
+            return None
+        return "object"
+    elif kind == "int":
+        if pd.api.types.is_integer_dtype(dtype):
+            return None
+        # Use pandas nullable integer type if there are NaNs
+        return "Int64" if series.hasnans else "int64"
+    elif kind == "float":
+        if pd.api.types.is_float_dtype(dtype):
+            return None
+        # Use pandas nullable type if there are NaNs
+        return "Float64" if series.hasnans else "float64"
+    elif kind == "datetime":
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return None
+        return "datetime64[ns]"
+    elif kind == "bool":
+        if pd.api.types.is_bool_dtype(dtype):
+            return None
+        # Use pandas nullable type if there are NaNs, rather than converting them to False
+        return "boolean" if series.hasnans else "bool"
+    else:
+        return None if pd.api.types.is_object_dtype(dtype) else "object"
 
 
-def _convert_df_dtypes_to_db(table_data: TableData, table_columns: List[str]):
+def _convert_df_dtypes_to_db(
+    table_data: TableData, table_columns: List[str]
+) -> pd.DataFrame:
     """
-    Convert dataframe columns to match database column types by
-    mapping SQLAlchemy types to pandas-compatible dtypes
+    Return a dataframe of table_columns with dtypes that match the database column types.
+    Only columns that need conversion are copied; others share data with table_data.df.
     """
-    df = table_data.df.copy()
+    plan = _get_dtype_plan(table_data.table)
+    df = table_data.df
+    columns = {}
     for col in table_columns:
-        if col in df.columns:
-            sa_column = table_data.table.__table__.columns[col]
-            current_dtype = str(df[col].dtype)
-
-            if isinstance(sa_column.type, sqlalchemy.String):
-                target_dtype = "object"
-            elif isinstance(sa_column.type, sqlalchemy.Integer):
-                # Use pandas nullable integer type if there are NaNs
-                target_dtype = "Int64" if df[col].isna().any() else "int64"
-            elif isinstance(sa_column.type, sqlalchemy.Float):
-                # Use pandas nullable type if there are NaNs
-                target_dtype = "Float64" if df[col].isna().any() else "float64"
-            elif isinstance(sa_column.type, sqlalchemy.DateTime) or isinstance(
-                sa_column.type, sqlalchemy.Date
-            ):
-                target_dtype = "datetime64[ns]"
-            elif isinstance(sa_column.type, sqlalchemy.Boolean):
-                target_dtype = "bool"
-            else:
-                target_dtype = "object"
+        target_dtype = _get_target_dtype(plan[col], df[col])
+        if target_dtype is None:
+            columns[col] = df[col]
+        else:
+            logging.debug(
+                f"Converting column {col} from {df[col].dtype} to {target_dtype}"
+            )
+            columns[col] = df[col].astype(target_dtype)
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def read_table(
+    session: Session,
+    table: SQLModel,
+    columns: List[str] = None,
+    where: sqlalchemy.ColumnElement | List[sqlalchemy.ColumnElement] = None,
+    chunksize: int = None,
+    categorical: bool = True,
+) -> pd.DataFrame | Iterator[pd.DataFrame]:
+    """
+    Read rows of table into a dataframe with dtypes derived from the table's columns:
+    nullable Int64 for integers, float64, datetime64[ns], nullable boolean, and object
+    or category for strings.
+
+    Args:
+        columns: Column names to read. Defaults to all columns. Only these are selected.
+        where: SQLAlchemy filter expression, or list of them, applied in SQL, e.g.
+            PrwEncounterOutpt.encounter_date >= datetime(2024, 1, 1)
+        chunksize: If set, return an iterator of dataframes of at most chunksize rows,
+            fetched incrementally from the DB using a server-side cursor where supported
+        categorical: Convert string columns where fewer than half of the values are
+            unique to category. With chunksize, this is decided per chunk.
+    """
+    sa_table = table.__table__
+    columns = columns or sa_table.columns.keys()
+    unknown = [col for col in columns if col not in sa_table.columns]
+    if unknown:
+        raise ValueError(f"Columns not in {sa_table.name}: {', '.join(unknown)}")
+
+    stmt = sqlalchemy.select(*[sa_table.columns[col] for col in columns])
+    if where is not None:
+        stmt = stmt.where(*(where if isinstance(where, (list, tuple)) else [where]))
+
+    if chunksize is None:
+        with metrics_utils.stage(sa_table.name, "read") as stage:
+            rows = session.connection().execute(stmt).all()
+            df = _convert_df_dtypes_from_db(table, rows, columns, categorical)
+            stage.rows = len(df)
+        logging.info(f"Read {len(df)} rows from {sa_table.name}")
+        return df
+    return _read_table_chunks(session, table, stmt, columns, chunksize, categorical)
+
+
+def _read_table_chunks(
+    session: Session,
+    table: SQLModel,
+    stmt: sqlalchemy.Select,
+    columns: List[str],
+    chunksize: int,
+    categorical: bool,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield the results of stmt as typed dataframes of at most chunksize rows
+    """
+    table_name = table.__tablename__
+    # Stream this statement only. Options set on the Session's connection would persist.
+    result = session.connection().execute(
+        stmt, execution_options={"yield_per": chunksize}
+    )
+    nrows = 0
+    while True:
+        start_time = time.time()
+        rows = result.fetchmany(chunksize)
+        if not rows:
+            break
+        df = _convert_df_dtypes_from_db(table, rows, columns, categorical)
+        metrics_utils.record(table_name, "read", time.time() - start_time, rows=len(df))
+        nrows += len(df)
+        yield df
+    logging.info(f"Read {nrows} rows from {table_name}")
 
-            # Only convert if needed
-            if current_dtype != target_dtype:
-                logging.info(
-                    f"Converting column {col} from {current_dtype} to {target_dtype}"
-                )
-                df[col] = df[col].astype(target_dtype, copy=False)
 
-    return df
+def _convert_df_dtypes_from_db(
+    table: SQLModel, rows: List[tuple], columns: List[str], categorical: bool
+) -> pd.DataFrame:
+    """
+    Build a dataframe from DB result rows with dtypes that match the table's column types
+    """
+    plan = _get_dtype_plan(table)
+    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=False)
+    converted = {}
+    for col in columns:
+        kind, series = plan[col], df[col]
+        if kind == "int":
+            series = series.astype("Int64")
+        elif kind == "float":
+            series = series.astype("float64")
+        elif kind == "datetime":
+            series = pd.to_datetime(series)
+        elif kind == "bool":
+            series = series.astype("boolean")
+        elif kind == "string" and categorical and len(series):
+            # All-null columns stay object, as an empty category does not round trip
+            # through Parquet in cache_utils
+            if 0 < series.nunique() < len(series) / 2:
+                series = series.astype("category")
+        converted[col] = series
+    return pd.DataFrame(converted, copy=False)
 
 
 def write_kv_table(kv_data: dict, session: Session, kv_table: SQLModel):
@@ -273,3 +1838,29 @@ def write_meta(session: Session, meta_table: SQLModel):
     else:
         meta = meta_table(modified=datetime.now())
         session.add(meta)
+
+
+def write_run_metrics(
+    session: Session,
+    metrics_table: SQLModel,
+    run_metrics: "metrics_utils.RunMetrics" = None,
+):
+    """
+    Append the stage metrics for a run, by default the current run in metrics_utils,
+    to a table like PrwIngestMetrics so load performance can be tracked over time
+    """
+    run_metrics = run_metrics or metrics_utils.get_run_metrics()
+    logging.info(f"Writing run metrics: {run_metrics.run}")
+    for m in run_metrics.stages:
+        session.add(
+            metrics_table(
+                run=run_metrics.run,
+                run_start=run_metrics.started,
+                name=m.name,
+                stage=m.stage,
+                seconds=m.seconds,
+                rows=m.rows,
+                bytes=m.bytes,
+                peak_rss=m.peak_rss,
+            )
+        )
@@ -1,16 +1,97 @@
 """
-Symmetric encryption and decryption using AES-256 in CBC mode.
-Run this file directly to print out a new randomly generated key.
+Symmetric authenticated encryption and decryption using AES-256-GCM, ChaCha20-Poly1305
+or AES-256-CTR with HMAC-SHA256. Run this file directly to print out a new randomly
+generated key.
+
+Data is encrypted in a segmented format: a header followed by fixed-size segments that
+are each encrypted and authenticated independently, so files of any size can be
+processed with constant memory using encrypt_stream() / decrypt_stream(). The header
+records the cipher, so decryption detects it automatically. Decryption also reads the
+original single-block format (IV + AES-CBC ciphertext + HMAC).
+
+Data can optionally be compressed with zstd, lzma or zlib before it is encrypted. The
+header records the compression, and decryption decompresses transparently.
+
+Since segments have a fixed size, any byte range can be located and decrypted on its
+own. EncryptedFile opens an encrypted file as a read-only, seekable file object that
+decrypts only the segments that are read, e.g. to pass to a Parquet reader.
 """
 
+import io
 import sys, os
+import lzma
+import zlib
+import struct
+import contextlib
 import argparse
 import base64
 import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    from . import metrics_utils
+except ImportError:
+    import metrics_utils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Segmented format:
+#   header:  magic | version | cipher | flags | reserved | segment size | nonce
+#   segment: ciphertext (same length as plaintext) | tag
+# Every segment except the last holds exactly segment size bytes of plaintext. Each tag
+# covers the header, the segment index and whether it is the last segment, so segments
+# cannot be reordered, dropped or truncated without detection. The low bits of flags
+# hold the compression applied to the data before it was encrypted.
+MAGIC = b"PRWENC"
+FORMAT_VERSION = 2
+CIPHER_AES_CTR_HMAC = 1
+CIPHER_AES_GCM = 2
+CIPHER_CHACHA20_POLY1305 = 3
+
+# Cipher names accepted by encrypt functions. The AEAD ciphers encrypt and authenticate
+# in a single pass. AES-GCM is fastest on CPUs with AES-NI; ChaCha20-Poly1305 is faster
+# on CPUs without hardware AES.
+CIPHERS = {
+    "aes-gcm": CIPHER_AES_GCM,
+    "chacha20-poly1305": CIPHER_CHACHA20_POLY1305,
+    "aes-ctr-hmac": CIPHER_AES_CTR_HMAC,
+}
+DEFAULT_CIPHER = "aes-gcm"
+
+# Compression names accepted by encrypt functions. "auto" uses zstd if the zstandard
+# package is installed, otherwise zlib.
+COMPRESS_NONE = 0
+COMPRESS_ZSTD = 1
+COMPRESS_LZMA = 2
+COMPRESS_ZLIB = 3
+COMPRESSIONS = {"zstd": COMPRESS_ZSTD, "lzma": COMPRESS_LZMA, "zlib": COMPRESS_ZLIB}
+_COMPRESSION_MASK = 0x0F
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+_HEADER = struct.Struct(">6sBBBxI8s")
+_MAX_SEGMENTS = 2**32
+
+# Parallel file encryption reads and writes segments in place. Not available on Windows.
+_HAS_PREAD = hasattr(os, "pread") and hasattr(os, "pwrite")
+
+# Buffer size for streaming the legacy format
+_LEGACY_BUFFER_SIZE = 1024 * 1024
+
+# Size of reads from the input when compressing
+_COMPRESS_BUFFER_SIZE = 1024 * 1024
 
 
 def generate_key():
@@ -19,7 +100,610 @@ def generate_key():
     return base64.urlsafe_b64encode(key).decode("utf-8")
 
 
-def encrypt(data: bytes, key_str: str) -> bytes:
+def encrypt(
+    data: bytes,
+    key_str: str,
+    legacy: bool = False,
+    cipher: str = DEFAULT_CIPHER,
+    compression: str = None,
+    level: int = None,
+) -> bytes:
+    """
+    Encrypt data in the segmented format with the given cipher (see CIPHERS), or the
+    original single-block format if legacy is set, for readers that have not been updated.
+    If compression is set (see COMPRESSIONS), data is compressed at the given level first.
+    """
+    if legacy:
+        return _encrypt_legacy(data, key_str)
+    out = io.BytesIO()
+    encrypt_stream(
+        io.BytesIO(data),
+        out,
+        key_str,
+        cipher=cipher,
+        compression=compression,
+        level=level,
+    )
+    return out.getvalue()
+
+
+def decrypt(data: bytes, key_str: str) -> bytes:
+    """
+    Decrypt data in either the segmented or legacy format
+    """
+    if not _is_segmented(data):
+        return _decrypt_legacy(data, key_str)
+    out = io.BytesIO()
+    decrypt_stream(io.BytesIO(data), out, key_str)
+    return out.getvalue()
+
+
+def encrypt_file(
+    file: str,
+    outfile: str,
+    key: str,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    legacy: bool = False,
+    jobs: int = None,
+    cipher: str = DEFAULT_CIPHER,
+    compression: str = None,
+    level: int = None,
+):
+    """
+    Encrypt file to outfile with the given cipher (see CIPHERS). Segments are encrypted
+    in parallel by up to jobs threads, default one per CPU, and written directly to
+    their offsets in outfile.
+
+    If compression is set (see COMPRESSIONS), the file is compressed at the given level
+    as it is read and encrypted as a stream. zstd compresses with jobs threads.
+    """
+    with metrics_utils.stage(
+        os.path.basename(file), "encrypt", bytes=os.path.getsize(file)
+    ):
+        if legacy:
+            with open(file, "rb") as f:
+                data = f.read()
+            with open(f"{outfile}", "wb") as f:
+                f.write(_encrypt_legacy(data, key))
+            return
+
+        jobs = jobs or os.cpu_count() or 1
+        with open(file, "rb") as fin, open(f"{outfile}", "wb") as fout:
+            if compression:
+                encrypt_stream(
+                    fin, fout, key, segment_size, cipher, compression, level, jobs
+                )
+            elif jobs > 1 and _HAS_PREAD:
+                _encrypt_file_parallel(fin, fout, key, segment_size, jobs, cipher)
+            else:
+                encrypt_stream(fin, fout, key, segment_size, cipher)
+
+
+def decrypt_file(file: str, outfile: str, key: str, jobs: int = None):
+    """
+    Decrypt file to outfile. Uncompressed segmented files are verified and decrypted in
+    parallel by up to jobs threads, default one per CPU. If verification fails, outfile
+    is removed.
+    """
+    with metrics_utils.stage(
+        os.path.basename(file), "decrypt", bytes=os.path.getsize(file)
+    ):
+        jobs = jobs or os.cpu_count() or 1
+        try:
+            with open(file, "rb") as fin, open(f"{outfile}", "wb") as fout:
+                header = _read_full(fin, _HEADER.size)
+                fin.seek(0)
+                if (
+                    jobs > 1
+                    and _HAS_PREAD
+                    and _is_segmented(header)
+                    and not _get_compression(header)
+                ):
+                    _decrypt_file_parallel(fin, fout, key, jobs)
+                else:
+                    decrypt_stream(fin, fout, key)
+        except Exception:
+            # outfile may not exist, e.g. if its directory is missing
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(outfile)
+            raise
+
+
+def encrypt_stream(
+    fin: BinaryIO,
+    fout: BinaryIO,
+    key_str: str,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    cipher: str = DEFAULT_CIPHER,
+    compression: str = None,
+    level: int = None,
+    jobs: int = None,
+) -> int:
+    """
+    Encrypt everything read from fin and write it to fout in the segmented format. Holds
+    at most two segments in memory. If compression is set (see COMPRESSIONS), data is
+    compressed at the given level before it is encrypted, by jobs threads for zstd.
+    Returns the number of bytes encrypted, after compression.
+    """
+    compression_id = _get_compression_id(compression)
+    header = _new_header(segment_size, cipher, compression_id)
+    segment_cipher = _SegmentCipher(base64.urlsafe_b64decode(key_str), header)
+    fout.write(header)
+    if compression_id:
+        fin = _CompressingReader(fin, compression_id, level, jobs)
+
+    # Read one segment ahead to know which segment is the last
+    index, nbytes = 0, 0
+    segment = _read_full(fin, segment_size)
+    while True:
+        next_segment = _read_full(fin, segment_size) if segment else b""
+        final = not next_segment
+        fout.write(segment_cipher.encrypt_segment(index, segment, final))
+        nbytes += len(segment)
+        if final:
+            return nbytes
+        segment = next_segment
+        index += 1
+
+
+def decrypt_stream(fin: BinaryIO, fout: BinaryIO, key_str: str) -> int:
+    """
+    Decrypt data read from fin in either format and write the plaintext to fout. The
+    segmented format is verified, decrypted and decompressed if needed one segment at a
+    time with constant memory. Returns the number of plaintext bytes written.
+    """
+    key = base64.urlsafe_b64decode(key_str)
+    header = _read_full(fin, _HEADER.size)
+    if not _is_segmented(header):
+        return _decrypt_legacy_stream(header, fin, fout, key)
+
+    _, _, _, _, segment_size, _ = _HEADER.unpack(header)
+    cipher = _SegmentCipher(key, header)
+    stored_size = segment_size + cipher.tag_size
+    compression_id = _get_compression(header)
+    if compression_id:
+        fout = _DecompressingWriter(fout, compression_id)
+
+    index, nbytes = 0, 0
+    blob = _read_full(fin, stored_size)
+    while True:
+        next_blob = _read_full(fin, stored_size) if len(blob) == stored_size else b""
+        final = not next_blob
+        plaintext = cipher.decrypt_segment(index, blob, final)
+        nbytes += fout.write(plaintext)
+        if final:
+            if compression_id:
+                fout.finish()
+            return nbytes
+        blob = next_blob
+        index += 1
+
+
+def _encrypt_file_parallel(
+    fin: BinaryIO,
+    fout: BinaryIO,
+    key_str: str,
+    segment_size: int,
+    jobs: int,
+    cipher: str = DEFAULT_CIPHER,
+):
+    """
+    Encrypt segments of fin concurrently. Output offsets are known up front since each
+    segment's ciphertext is the same size as its plaintext, so fout is preallocated and
+    each segment written in place with pwrite.
+    """
+    header = _new_header(segment_size, cipher)
+    segment_cipher = _SegmentCipher(base64.urlsafe_b64decode(key_str), header)
+    tag_size = segment_cipher.tag_size
+    stored_size = segment_size + tag_size
+
+    size = os.fstat(fin.fileno()).st_size
+    nsegments = max(1, -(-size // segment_size))
+    fout.write(header)
+    fout.flush()
+    fout.truncate(len(header) + size + nsegments * tag_size)
+
+    def encrypt_segment(index: int):
+        data = _pread_full(fin.fileno(), segment_size, index * segment_size)
+        blob = segment_cipher.encrypt_segment(index, data, index == nsegments - 1)
+        os.pwrite(fout.fileno(), blob, len(header) + index * stored_size)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(encrypt_segment, range(nsegments)):
+            pass
+
+
+def _decrypt_file_parallel(fin: BinaryIO, fout: BinaryIO, key_str: str, jobs: int):
+    """
+    Verify and decrypt segments of a segmented format file concurrently, writing each
+    segment's plaintext in place with pwrite
+    """
+    header = _read_full(fin, _HEADER.size)
+    _, _, _, _, segment_size, _ = _HEADER.unpack(header)
+    cipher = _SegmentCipher(base64.urlsafe_b64decode(key_str), header)
+    stored_size = segment_size + cipher.tag_size
+
+    body_size = os.fstat(fin.fileno()).st_size - len(header)
+    nsegments, plaintext_size = cipher.layout(body_size)
+    fout.truncate(plaintext_size)
+
+    def decrypt_segment(index: int):
+        blob = _pread_full(fin.fileno(), stored_size, len(header) + index * stored_size)
+        plaintext = cipher.decrypt_segment(index, blob, index == nsegments - 1)
+        os.pwrite(fout.fileno(), plaintext, index * segment_size)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(decrypt_segment, range(nsegments)):
+            pass
+
+
+class EncryptedFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a segmented format file. Segments are read,
+    verified and decrypted on demand, and the most recently used are kept in memory.
+    The last segment is verified on open, so a truncated file is rejected up front.
+
+    Usage:
+        with EncryptedFile("data.parquet.enc", key) as f:
+            df = pd.read_parquet(f)
+    """
+
+    def __init__(self, file: str | BinaryIO, key_str: str, cache_segments: int = 8):
+        super().__init__()
+        self._owns_file = isinstance(file, str)
+        self._f = open(file, "rb") if self._owns_file else file
+        try:
+            self._f.seek(0)
+            header = _read_full(self._f, _HEADER.size)
+            if not _is_segmented(header) or _get_compression(header):
+                raise ValueError(
+                    "Random access requires the uncompressed segmented format, use decrypt_file()"
+                )
+            self._cipher = _SegmentCipher(base64.urlsafe_b64decode(key_str), header)
+            body_size = self._f.seek(0, os.SEEK_END) - len(header)
+            self._nsegments, self.size = self._cipher.layout(body_size)
+            self._pos = 0
+            self._cache = OrderedDict()
+            self._cache_segments = max(1, cache_segments)
+            self._lock = threading.Lock()
+            self._segment(self._nsegments - 1)
+        except Exception:
+            if self._owns_file:
+                self._f.close()
+            raise
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position: {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, b) -> int:
+        """
+        Read up to len(b) bytes at the current position into b, spanning segments as
+        needed. Only returns fewer bytes at end of file.
+        """
+        out = memoryview(b).cast("B")
+        segment_size = self._cipher.segment_size
+        nbytes = 0
+        while nbytes < len(out) and self._pos < self.size:
+            index, offset = divmod(self._pos, segment_size)
+            data = self._segment(index)[offset : offset + len(out) - nbytes]
+            out[nbytes : nbytes + len(data)] = data
+            nbytes += len(data)
+            self._pos += len(data)
+        return nbytes
+
+    def close(self):
+        if not self.closed and self._owns_file:
+            self._f.close()
+        super().close()
+
+    def _segment(self, index: int) -> bytes:
+        """
+        Return the plaintext of segment number index, from the cache if possible
+        """
+        with self._lock:
+            plaintext = self._cache.get(index)
+            if plaintext is not None:
+                self._cache.move_to_end(index)
+                return plaintext
+
+            stored_size = self._cipher.segment_size + self._cipher.tag_size
+            self._f.seek(_HEADER.size + index * stored_size)
+            blob = _read_full(self._f, stored_size)
+            plaintext = self._cipher.decrypt_segment(
+                index, blob, index == self._nsegments - 1
+            )
+            self._cache[index] = plaintext
+            if len(self._cache) > self._cache_segments:
+                self._cache.popitem(last=False)
+            return plaintext
+
+
+class _SegmentCipher:
+    """
+    Encrypts and authenticates individual segments of a file with the given header,
+    using the cipher the header specifies. Segments are independent, so they may be
+    processed in any order.
+    """
+
+    def __init__(self, key: bytes, header: bytes):
+        magic, version, cipher_id, flags, segment_size, nonce = _HEADER.unpack(header)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Unsupported encrypted data format")
+        if cipher_id not in CIPHERS.values():
+            raise ValueError(f"Unsupported cipher: {cipher_id}")
+
+        # Derive a per-file encryption key, plus a separate authentication key for HMAC
+        derived = HKDF(
+            algorithm=hashes.SHA256(),
+            length=64,
+            salt=nonce,
+            info=b"prw encrypt segmented",
+            backend=default_backend(),
+        ).derive(key)
+        self.enc_key, self.mac_key = derived[:32], derived[32:]
+        self.header = header
+        self.nonce = nonce
+        self.segment_size = segment_size
+        if cipher_id == CIPHER_AES_GCM:
+            self.aead = AESGCM(self.enc_key)
+        elif cipher_id == CIPHER_CHACHA20_POLY1305:
+            self.aead = ChaCha20Poly1305(self.enc_key)
+        else:
+            self.aead = None
+        self.tag_size = 16 if self.aead else 32
+
+    def layout(self, body_size: int) -> tuple[int, int]:
+        """
+        Return the number of segments and plaintext size for body_size bytes of
+        segments following the header
+        """
+        stored_size = self.segment_size + self.tag_size
+        nsegments = max(1, -(-body_size // stored_size))
+        plaintext_size = body_size - nsegments * self.tag_size
+        if (
+            plaintext_size < 0
+            or body_size - (nsegments - 1) * stored_size < self.tag_size
+        ):
+            raise ValueError("Encrypted data is truncated")
+        return nsegments, plaintext_size
+
+    def encrypt_segment(self, index: int, plaintext: bytes, final: bool) -> bytes:
+        """
+        Return ciphertext + tag for segment number index
+        """
+        if self.aead:
+            return self.aead.encrypt(
+                self._aead_nonce(index), plaintext, self._aad(index, final)
+            )
+        encryptor = self._cipher(index).encryptor()
+        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        return ciphertext + self._tag(index, final, ciphertext)
+
+    def decrypt_segment(self, index: int, blob: bytes, final: bool) -> bytes:
+        """
+        Verify and decrypt a segment produced by encrypt_segment()
+        """
+        if len(blob) < self.tag_size:
+            raise ValueError("Encrypted data is truncated")
+        if self.aead:
+            try:
+                return self.aead.decrypt(
+                    self._aead_nonce(index), blob, self._aad(index, final)
+                )
+            except InvalidTag:
+                raise ValueError(
+                    "Authentication failed: Data may have been tampered with"
+                )
+        ciphertext = memoryview(blob)[: -self.tag_size]
+        tag = blob[-self.tag_size :]
+        if not secrets.compare_digest(self._tag(index, final, ciphertext), tag):
+            raise ValueError(
+                "HMAC verification failed: Data may have been tampered with"
+            )
+        decryptor = self._cipher(index).decryptor()
+        return decryptor.update(ciphertext) + decryptor.finalize()
+
+    def _aead_nonce(self, index: int) -> bytes:
+        # 96-bit nonce: file nonce | segment index
+        if index >= _MAX_SEGMENTS:
+            raise ValueError("Too many segments, use a larger segment size")
+        return self.nonce + struct.pack(">I", index)
+
+    def _aad(self, index: int, final: bool) -> bytes:
+        # Authenticated with every segment: header | segment index | last segment flag
+        return self.header + struct.pack(">QB", index, final)
+
+    def _cipher(self, index: int) -> Cipher:
+        # Counter block: file nonce | segment index | block counter within segment
+        if index >= _MAX_SEGMENTS:
+            raise ValueError("Too many segments, use a larger segment size")
+        iv = self.nonce + struct.pack(">II", index, 0)
+        return Cipher(
+            algorithms.AES(self.enc_key), modes.CTR(iv), backend=default_backend()
+        )
+
+    def _tag(self, index: int, final: bool, ciphertext: bytes) -> bytes:
+        h = hmac.HMAC(self.mac_key, hashes.SHA256(), backend=default_backend())
+        h.update(self._aad(index, final))
+        h.update(ciphertext)
+        return h.finalize()
+
+
+def _new_header(
+    segment_size: int, cipher: str = DEFAULT_CIPHER, compression_id: int = COMPRESS_NONE
+) -> bytes:
+    """
+    Header for a new segmented format file with a random nonce
+    """
+    if segment_size <= 0:
+        raise ValueError(f"Invalid segment size: {segment_size}")
+    if cipher not in CIPHERS:
+        raise ValueError(f"Unknown cipher: {cipher}. Use one of {', '.join(CIPHERS)}")
+    return _HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        CIPHERS[cipher],
+        compression_id,
+        segment_size,
+        secrets.token_bytes(8),
+    )
+
+
+def _get_compression_id(compression: str | None) -> int:
+    """
+    Header compression ID for a compression name, see COMPRESSIONS
+    """
+    if not compression:
+        return COMPRESS_NONE
+    if compression == "auto":
+        compression = "zstd" if zstandard else "zlib"
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            f"Unknown compression: {compression}. Use one of {', '.join(COMPRESSIONS)}"
+        )
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+    return COMPRESSIONS[compression]
+
+
+def _get_compression(header: bytes) -> int:
+    """
+    Compression ID recorded in a segmented format header
+    """
+    _, _, _, flags, _, _ = _HEADER.unpack(header[: _HEADER.size])
+    return flags & _COMPRESSION_MASK
+
+
+class _CompressingReader:
+    """
+    Wraps a binary file so read() returns the compressed contents of the file
+    """
+
+    def __init__(
+        self, f: BinaryIO, compression_id: int, level: int = None, jobs: int = None
+    ):
+        self._f = f
+        self._buf = bytearray()
+        self._eof = False
+        if compression_id == COMPRESS_ZSTD:
+            self._compressor = zstandard.ZstdCompressor(
+                level=3 if level is None else level, threads=jobs or -1
+            ).compressobj()
+        elif compression_id == COMPRESS_LZMA:
+            self._compressor = lzma.LZMACompressor(
+                preset=lzma.PRESET_DEFAULT if level is None else level
+            )
+        else:
+            self._compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION if level is None else level
+            )
+
+    def read(self, size: int) -> bytes:
+        while len(self._buf) < size and not self._eof:
+            chunk = self._f.read(_COMPRESS_BUFFER_SIZE)
+            if chunk:
+                self._buf += self._compressor.compress(chunk)
+            else:
+                self._buf += self._compressor.flush()
+                self._eof = True
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+
+class _DecompressingWriter:
+    """
+    Wraps a binary file so write() decompresses data before writing it
+    """
+
+    def __init__(self, f: BinaryIO, compression_id: int):
+        self._f = f
+        if compression_id == COMPRESS_ZSTD:
+            if zstandard is None:
+                raise ImportError("Decrypting zstd data requires the zstandard package")
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif compression_id == COMPRESS_LZMA:
+            self._decompressor = lzma.LZMADecompressor()
+        elif compression_id == COMPRESS_ZLIB:
+            self._decompressor = zlib.decompressobj()
+        else:
+            raise ValueError(f"Unsupported compression: {compression_id}")
+
+    def write(self, data: bytes) -> int:
+        """
+        Decompress data and write it, returning the number of decompressed bytes
+        """
+        return self._f.write(self._decompressor.decompress(data))
+
+    def finish(self):
+        """
+        Check that the compressed stream was complete
+        """
+        if not self._decompressor.eof:
+            raise ValueError("Compressed data is truncated")
+
+
+def _is_segmented(data: bytes) -> bool:
+    """
+    Whether data starts with a segmented format header
+    """
+    return len(data) >= _HEADER.size and data[: len(MAGIC)] == MAGIC
+
+
+def _read_full(f: BinaryIO, size: int) -> bytes:
+    """
+    Read exactly size bytes from f, or fewer only at end of file
+    """
+    data = f.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        part = f.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b"".join(parts)
+
+
+def _pread_full(fd: int, size: int, offset: int) -> bytes:
+    """
+    Read up to size bytes at offset, fewer only at end of file
+    """
+    parts = []
+    while size:
+        data = os.pread(fd, size, offset)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+        offset += len(data)
+    return b"".join(parts)
+
+
+def _encrypt_legacy(data: bytes, key_str: str) -> bytes:
     # Decode the base64 key
     key = base64.urlsafe_b64decode(key_str)
 
@@ -44,15 +728,7 @@ def encrypt(data: bytes, key_str: str) -> bytes:
     return iv + ciphertext + hmac_digest
 
 
-def encrypt_file(file: str, outfile: str, key: str):
-    with open(file, "rb") as f:
-        data = f.read()
-    encrypted = encrypt(data, key)
-    with open(f"{outfile}", "wb") as f:
-        f.write(encrypted)
-
-
-def decrypt(data: bytes, key_str: str) -> bytes:
+def _decrypt_legacy(data: bytes, key_str: str) -> bytes:
     # Decode the base64 key
     key = base64.urlsafe_b64decode(key_str)
 
@@ -81,12 +757,55 @@ def decrypt(data: bytes, key_str: str) -> bytes:
     return plaintext
 
 
-def decrypt_file(file: str, outfile: str, key: str):
-    with open(file, "rb") as f:
-        data = f.read()
-    decrypted = decrypt(data, key)
-    with open(f"{outfile}", "wb") as f:
-        f.write(decrypted)
+def _decrypt_legacy_stream(
+    prefix: bytes, fin: BinaryIO, fout: BinaryIO, key: bytes
+) -> int:
+    """
+    Decrypt the legacy format, where prefix holds bytes already read from fin. Seekable
+    inputs are verified in one pass and decrypted in a second pass with constant memory.
+    Otherwise the whole input is read into memory.
+    """
+    key_str = base64.urlsafe_b64encode(key).decode("utf-8")
+    if not fin.seekable():
+        plaintext = _decrypt_legacy(prefix + fin.read(), key_str)
+        fout.write(plaintext)
+        return len(plaintext)
+
+    start = fin.tell() - len(prefix)
+    end = fin.seek(0, os.SEEK_END)
+    if end - start < 16 + 32:
+        raise ValueError("Encrypted data is truncated")
+
+    # Verify HMAC over IV + ciphertext
+    fin.seek(start)
+    h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
+    remaining = end - start - 32
+    while remaining:
+        chunk = fin.read(min(_LEGACY_BUFFER_SIZE, remaining))
+        h.update(chunk)
+        remaining -= len(chunk)
+    try:
+        h.verify(fin.read(32))
+    except Exception:
+        raise ValueError("HMAC verification failed: Data may have been tampered with")
+
+    # Decrypt and unpad
+    fin.seek(start)
+    iv = fin.read(16)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    decryptor = cipher.decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    remaining = end - start - 16 - 32
+    nbytes = 0
+    while remaining:
+        chunk = fin.read(min(_LEGACY_BUFFER_SIZE, remaining))
+        remaining -= len(chunk)
+        plaintext = unpadder.update(decryptor.update(chunk))
+        fout.write(plaintext)
+        nbytes += len(plaintext)
+    plaintext = unpadder.update(decryptor.finalize()) + unpadder.finalize()
+    fout.write(plaintext)
+    return nbytes + len(plaintext)
 
 
 # Run as script. With no parameters, will generate a new key. Use -key to specify key to use,
@@ -94,7 +813,7 @@ def decrypt_file(file: str, outfile: str, key: str):
 # Use -out  to specify output filename, otherwise will default to .enc or .dec
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Encrypt and decrypt files. Uses AES-256 in CBC mode with HMAC-SHA256 authentication. Run without arguments to generate a new key."
+        description="Encrypt and decrypt files. Uses AES-256-GCM authenticated encryption by default. Run without arguments to generate a new key."
     )
     parser.add_argument("file", nargs="?", help="File to encrypt/decrypt")
     parser.add_argument(
@@ -113,6 +832,35 @@ if __name__ == "__main__":
         "--out",
         help="Output filename. Defaults to input filename with .enc or .dec extension",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of threads to encrypt/decrypt with. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cipher",
+        default=DEFAULT_CIPHER,
+        choices=list(CIPHERS),
+        help=f"Cipher to encrypt with. Defaults to {DEFAULT_CIPHER}. Detected automatically when decrypting.",
+    )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        choices=["auto", *COMPRESSIONS],
+        help="Compress before encrypting. auto uses zstd if installed, otherwise zlib.",
+    )
+    parser.add_argument(
+        "--level",
+        type=int,
+        help="Compression level. Defaults to the compression library's default.",
+    )
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Encrypt in the original single-block format for older readers",
+    )
     args = parser.parse_args()
 
     # Use provided key or generate new one
@@ -132,7 +880,16 @@ if __name__ == "__main__":
     # Handle encryption
     if not args.decrypt:
         out = args.out if args.out else args.file + ".enc"
-        encrypt_file(args.file, out, key)
+        encrypt_file(
+            args.file,
+            out,
+            key,
+            legacy=args.legacy,
+            jobs=args.jobs,
+            cipher=args.cipher,
+            compression=args.compress,
+            level=args.level,
+        )
         print(f"Encrypted {args.file} -> {out}")
 
     # Handle decryption
@@ -145,5 +902,5 @@ if __name__ == "__main__":
         else:
             out = args.file + ".dec"
 
-        decrypt_file(args.file, out, key)
+        decrypt_file(args.file, out, key, jobs=args.jobs)
         print(f"Decrypted {args.file} -> {out}")
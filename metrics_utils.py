@@ -0,0 +1,220 @@
+"""
+Per-stage timing, throughput and memory metrics for ingest runs.
+
+db_utils, remote_utils and encrypt record each stage (clear, convert, write, commit,
+upload, encrypt...) into a process-wide RunMetrics. At the end of a run, write it out
+as a JSON report or a Prometheus textfile, or to the DB with db_utils.write_run_metrics().
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+@dataclass
+class StageMetrics:
+    """
+    Totals for one stage of processing a table or file
+    """
+
+    name: str
+    stage: str
+    seconds: float = 0.0
+    rows: int | None = None
+    bytes: int | None = None
+    peak_rss: int | None = None
+
+    @property
+    def rows_per_sec(self) -> float | None:
+        if self.rows is None or not self.seconds:
+            return None
+        return self.rows / self.seconds
+
+    @property
+    def bytes_per_sec(self) -> float | None:
+        if self.bytes is None or not self.seconds:
+            return None
+        return self.bytes / self.seconds
+
+
+class RunMetrics:
+    """
+    Collects StageMetrics for a run. Repeated records for the same name and stage, such
+    as one per chunk, are summed. Safe to use from multiple threads.
+    """
+
+    def __init__(self, run: str = "ingest"):
+        self.run = run
+        self.started = datetime.now()
+        self._stages: dict[tuple[str, str], StageMetrics] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        name: str,
+        stage: str,
+        seconds: float,
+        rows: int | None = None,
+        bytes: int | None = None,
+    ):
+        """
+        Add the time, rows and bytes for one execution of a stage
+        """
+        peak_rss = get_peak_rss()
+        with self._lock:
+            metrics = self._stages.setdefault((name, stage), StageMetrics(name, stage))
+            metrics.seconds += seconds
+            if rows is not None:
+                metrics.rows = (metrics.rows or 0) + rows
+            if bytes is not None:
+                metrics.bytes = (metrics.bytes or 0) + bytes
+            metrics.peak_rss = peak_rss
+
+    @contextmanager
+    def stage(self, name: str, stage: str, rows: int = None, bytes: int = None):
+        """
+        Time the enclosed block as a stage. Yields a StageMetrics whose rows and bytes
+        can be set inside the block if they are not known up front.
+        """
+        current = StageMetrics(name, stage, rows=rows, bytes=bytes)
+        start_time = time.perf_counter()
+        try:
+            yield current
+        finally:
+            self.record(
+                name,
+                stage,
+                time.perf_counter() - start_time,
+                rows=current.rows,
+                bytes=current.bytes,
+            )
+
+    @property
+    def stages(self) -> list[StageMetrics]:
+        with self._lock:
+            return list(self._stages.values())
+
+    def to_dict(self) -> dict:
+        """
+        Summary of the run as a JSON-serializable dict
+        """
+        return {
+            "run": self.run,
+            "started": self.started.isoformat(),
+            "elapsed": (datetime.now() - self.started).total_seconds(),
+            "peak_rss": get_peak_rss(),
+            "stages": [
+                {
+                    **asdict(m),
+                    "rows_per_sec": m.rows_per_sec,
+                    "bytes_per_sec": m.bytes_per_sec,
+                }
+                for m in self.stages
+            ],
+        }
+
+    def write_json(self, path: str):
+        """
+        Write the run summary as a JSON report
+        """
+        _write_atomic(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path: str, prefix: str = "prw_ingest"):
+        """
+        Write the run summary in Prometheus textfile collector format
+        """
+        run = _prom_escape(self.run)
+        lines = []
+        for metric, help, attr in (
+            ("stage_seconds", "Time spent in stage", "seconds"),
+            ("stage_rows", "Rows processed in stage", "rows"),
+            ("stage_bytes", "Bytes processed in stage", "bytes"),
+        ):
+            lines.append(f"# HELP {prefix}_{metric} {help}")
+            lines.append(f"# TYPE {prefix}_{metric} gauge")
+            for m in self.stages:
+                value = getattr(m, attr)
+                if value is not None:
+                    labels = f'run="{run}",name="{_prom_escape(m.name)}",stage="{_prom_escape(m.stage)}"'
+                    lines.append(f"{prefix}_{metric}{{{labels}}} {value}")
+        lines.append(f"# HELP {prefix}_peak_rss_bytes Peak resident memory of the run")
+        lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+        lines.append(f'{prefix}_peak_rss_bytes{{run="{run}"}} {get_peak_rss() or 0}')
+        lines.append(
+            f"# HELP {prefix}_last_run_timestamp_seconds Start time of the run"
+        )
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(
+            f'{prefix}_last_run_timestamp_seconds{{run="{run}"}} {self.started.timestamp()}'
+        )
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+# Metrics for the current run, shared by all modules
+_run_metrics = RunMetrics()
+
+
+def get_run_metrics() -> RunMetrics:
+    """
+    Return the metrics collector for the current run
+    """
+    return _run_metrics
+
+
+def reset_run_metrics(run: str = "ingest") -> RunMetrics:
+    """
+    Start collecting metrics for a new run, discarding any previous stages
+    """
+    global _run_metrics
+    _run_metrics = RunMetrics(run)
+    return _run_metrics
+
+
+def record(name: str, stage: str, seconds: float, rows: int = None, bytes: int = None):
+    """
+    Record a stage in the current run's metrics. See RunMetrics.record().
+    """
+    _run_metrics.record(name, stage, seconds, rows=rows, bytes=bytes)
+
+
+def stage(name: str, stage: str, rows: int = None, bytes: int = None):
+    """
+    Time a block as a stage in the current run's metrics. See RunMetrics.stage().
+    """
+    return _run_metrics.stage(name, stage, rows=rows, bytes=bytes)
+
+
+def get_peak_rss() -> int | None:
+    """
+    Peak resident memory of this process in bytes, or None if unavailable
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _prom_escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path: str, content: str):
+    """
+    Write to a temp file and rename, so readers never see a partial file
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
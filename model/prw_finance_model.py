@@ -14,7 +14,7 @@ class PrwVolume(PrwFinanceModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     dept_wd_id: str = Field(max_length=10)
     dept_name: Optional[str] = None
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     volume: int
     unit: Optional[str] = None
 
@@ -27,7 +27,7 @@ class PrwMiscVolume(PrwFinanceModel, table=True):
 
     __tablename__ = "prw_volumes_misc"
     id: Optional[int] = Field(default=None, primary_key=True)
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     metric: str = Field(max_length=32)
     volume: int
 
@@ -37,7 +37,7 @@ class PrwUOS(PrwFinanceModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     dept_wd_id: str = Field(max_length=10)
     dept_name: Optional[str] = None
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     volume: float
     unit: Optional[str] = None
 
@@ -60,7 +60,7 @@ class PrwBudget(PrwFinanceModel, table=True):
 class PrwHours(PrwFinanceModel, table=True):
     __tablename__ = "prw_hours"
     id: Optional[int] = Field(default=None, primary_key=True)
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     dept_wd_id: str = Field(max_length=10)
     dept_name: Optional[str] = None
     reg_hrs: float
@@ -76,7 +76,7 @@ class PrwContractedHours(PrwFinanceModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     dept_wd_id: str = Field(max_length=10)
     dept_name: Optional[str] = None
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     name: str = Field(description="Name of employee")
     type: str = Field(description="License of employee, eg. RN, MD, imaging, etc")
     reg_hrs: Optional[float] = None
@@ -106,7 +106,7 @@ class PrwHoursByPayPeriod(PrwFinanceModel, table=True):
 class PrwIncomeStmt(PrwFinanceModel, table=True):
     __tablename__ = "prw_income_stmt"
     id: Optional[int] = Field(default=None, primary_key=True)
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     ledger_acct: str
     dept_wd_id: str = Field(max_length=48)
     dept_name: Optional[str] = None
@@ -121,7 +121,7 @@ class PrwIncomeStmt(PrwFinanceModel, table=True):
 class PrwBalanceSheet(PrwFinanceModel, table=True):
     __tablename__ = "prw_balance_sheet"
     id: Optional[int] = Field(default=None, primary_key=True)
-    month: str = Field(max_length=7)
+    month: str = Field(max_length=7, index=True)
     tree: str = Field(
         description="Tree path for this line item, with levels separated by '|', which forms a hierarchy for line items in balance sheet"
     )
@@ -1,6 +1,7 @@
 from sqlalchemy.orm import registry
 from sqlmodel import Field, SQLModel
 from datetime import datetime
+from sqlalchemy import BigInteger
 
 
 class PrwMetaModel(SQLModel, registry=registry()):
@@ -19,3 +20,37 @@ class PrwSourcesMeta(PrwMetaModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     source: str = Field(unique=True, max_length=1024, index=True)
     modified: datetime
+
+
+class PrwSourcesWatermark(PrwMetaModel, table=True):
+    """
+    High-watermark of the data loaded so far from each source, written by
+    db_utils.write_incremental()
+    """
+
+    __tablename__ = "prw_sources_watermark"
+    id: int | None = Field(default=None, primary_key=True)
+    source: str = Field(unique=True, max_length=1024, index=True)
+    watermark_col: str = Field(max_length=1024)
+    watermark: str = Field(max_length=1024, description="Encoded high-watermark value")
+    watermark_type: str = Field(max_length=16, description="datetime, int or str")
+    modified: datetime
+
+
+class PrwIngestMetrics(PrwMetaModel, table=True):
+    """
+    Per-stage timings for each ingest run, written by db_utils.write_run_metrics()
+    """
+
+    __tablename__ = "prw_ingest_metrics"
+    id: int | None = Field(default=None, primary_key=True)
+    run: str = Field(max_length=1024, index=True)
+    run_start: datetime = Field(index=True)
+    name: str = Field(max_length=1024, description="Table or file name")
+    stage: str = Field(max_length=64)
+    seconds: float
+    rows: int | None = Field(default=None, sa_type=BigInteger)
+    bytes: int | None = Field(default=None, sa_type=BigInteger)
+    peak_rss: int | None = Field(
+        default=None, sa_type=BigInteger, description="Peak process memory in bytes"
+    )
@@ -0,0 +1,207 @@
+"""
+Bulk mapping between MRNs and prw_ids using the PrwId table in the PRW ID database.
+
+PrwIdIndex.load() reads all prw_ids once into sorted numpy arrays, so whole columns of
+MRNs are mapped with vectorized lookups instead of one query per patient. The index can
+be cached to a memory-mapped .npy file in cache_dir, which is reused until the row count
+or max id of the table changes. Requires no packages beyond numpy and pandas.
+
+Usage:
+    engine = db_utils.get_db_connection(args.prwid)
+    with Session(engine) as session:
+        index = PrwIdIndex.load(session, cache_dir="~/.cache/prw")
+        df["prw_id"] = index.assign_new_ids(session, df["mrn"])
+"""
+
+import os
+import glob
+import secrets
+import logging
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from typing import Callable
+from sqlmodel import SQLModel, Session, func, select
+
+try:
+    from . import db_utils, metrics_utils
+    from .model import PrwId
+except ImportError:
+    import db_utils, metrics_utils
+    from model import PrwId
+
+
+# Length and characters of generated prw_ids
+PRW_ID_LENGTH = 10
+PRW_ID_CHARS = "0123456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+
+
+class PrwIdIndex:
+    """
+    In-memory index of MRN <-> prw_id. Holds a structured array of (mrn, prw_id) sorted by
+    mrn, plus the sorted prw_ids and their row positions for reverse lookups.
+    """
+
+    def __init__(self, mrns: np.ndarray, prw_ids: np.ndarray):
+        self.data = _build_index(mrns, prw_ids)
+
+    @classmethod
+    def load(
+        cls, session: Session, table: SQLModel = PrwId, cache_dir: str = None
+    ) -> "PrwIdIndex":
+        """
+        Read all MRNs and prw_ids from table. If cache_dir is given, reuse a cached index
+        saved there for the same row count and max id, or save one after reading.
+        """
+        table_name = table.__tablename__
+        path = None
+        if cache_dir is not None:
+            cache_dir = os.path.expanduser(cache_dir)
+            count, max_id = session.exec(select(func.count(), func.max(table.id))).one()
+            prefix = os.path.join(cache_dir, f"{table_name}-index")
+            path = f"{prefix}-{count}-{max_id}.npy"
+            if os.path.exists(path):
+                index = cls.__new__(cls)
+                index.data = np.load(path, mmap_mode="r")
+                logging.info(f"Loaded {len(index)} prw_ids from {path}")
+                return index
+
+        with metrics_utils.stage(table_name, "read") as stage:
+            stmt = sqlalchemy.select(table.mrn, table.prw_id)
+            rows = session.connection().execute(stmt).all()
+            df = pd.DataFrame.from_records(rows, columns=["mrn", "prw_id"])
+            index = cls(df["mrn"].to_numpy(object), df["prw_id"].to_numpy(object))
+            stage.rows = len(index)
+        logging.info(f"Read {len(index)} prw_ids from {table_name}")
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            for stale_path in glob.glob(f"{glob.escape(prefix)}-*.npy"):
+                os.remove(stale_path)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, index.data)
+            os.replace(tmp_path, path)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def map_mrns(self, mrns: pd.Series) -> pd.Series:
+        """
+        Return the prw_id for each MRN in mrns, or NA for unknown and missing MRNs
+        """
+        pos = _lookup(self.data["mrn"], mrns)
+        return _take(self.data["prw_id"], pos, mrns.index, "prw_id")
+
+    def map_prw_ids(self, prw_ids: pd.Series) -> pd.Series:
+        """
+        Return the MRN for each prw_id in prw_ids, or NA for unknown and missing prw_ids
+        """
+        by_prw_id = self.data["by_prw_id"]
+        pos = _lookup(self.data["sorted_prw_id"], prw_ids)
+        if len(by_prw_id):
+            pos = np.where(pos >= 0, by_prw_id[np.maximum(pos, 0)], -1)
+        return _take(self.data["mrn"], pos, prw_ids.index, "mrn")
+
+    def assign_new_ids(
+        self,
+        session: Session,
+        mrns: pd.Series,
+        table: SQLModel = PrwId,
+        generate_ids: Callable[[int], np.ndarray] = None,
+    ) -> pd.Series:
+        """
+        Insert new prw_ids for MRNs in mrns that are not in the index, in one batch, and
+        return the prw_id for every MRN as in map_mrns(). New IDs are generated by
+        generate_ids(n), default generate_prw_ids(), and regenerated if they collide
+        with existing ones. Commits the session, then adds the new IDs to this index.
+        """
+        missing = mrns[mrns.notna() & (_lookup(self.data["mrn"], mrns) < 0)]
+        new_mrns = missing.astype(str).unique()
+        if len(new_mrns):
+            new_ids = self._new_prw_ids(len(new_mrns), generate_ids or generate_prw_ids)
+            df = pd.DataFrame({"mrn": new_mrns, "prw_id": new_ids})
+            db_utils.bulk_insert_df(session.connection(), table.__tablename__, df)
+            session.commit()
+            logging.info(f"Assigned {len(df)} new prw_ids in {table.__tablename__}")
+
+            self.data = _build_index(
+                np.concatenate([self.data["mrn"], new_mrns.astype(str)]),
+                np.concatenate([self.data["prw_id"], new_ids]),
+            )
+        return self.map_mrns(mrns)
+
+    def _new_prw_ids(self, n: int, generate_ids: Callable[[int], np.ndarray]):
+        """
+        Generate n prw_ids that are unique among themselves and the index
+        """
+        new_ids = np.asarray(generate_ids(n), dtype=str)
+        while True:
+            ids = pd.Series(new_ids)
+            taken = (ids.duplicated() | self.map_prw_ids(ids).notna()).to_numpy()
+            if not taken.any():
+                return new_ids
+            new_ids[taken] = np.asarray(generate_ids(int(taken.sum())), dtype=str)
+
+
+def generate_prw_ids(n: int, length: int = PRW_ID_LENGTH) -> np.ndarray:
+    """
+    Generate n random prw_ids of length characters from PRW_ID_CHARS
+    """
+    rng = np.random.default_rng(secrets.randbits(128))
+    chars = np.array(list(PRW_ID_CHARS))
+    codes = chars[rng.integers(0, len(chars), (n, length))]
+    return codes.view(f"U{length}").ravel()
+
+
+def _build_index(mrns: np.ndarray, prw_ids: np.ndarray) -> np.ndarray:
+    """
+    Structured array of (mrn, prw_id) sorted by mrn, with the sorted_prw_id field holding
+    the prw_ids in sorted order and by_prw_id the row position of each
+    """
+    mrns, prw_ids = mrns.astype(str), prw_ids.astype(str)
+    mrn_dtype = f"U{max(1, mrns.dtype.itemsize // 4)}"
+    prw_id_dtype = f"U{max(1, prw_ids.dtype.itemsize // 4)}"
+    data = np.empty(
+        len(mrns),
+        dtype=[
+            ("mrn", mrn_dtype),
+            ("prw_id", prw_id_dtype),
+            ("sorted_prw_id", prw_id_dtype),
+            ("by_prw_id", np.int64),
+        ],
+    )
+    order = np.argsort(mrns, kind="stable")
+    data["mrn"] = mrns[order]
+    data["prw_id"] = prw_ids[order]
+    data["by_prw_id"] = np.argsort(data["prw_id"], kind="stable")
+    data["sorted_prw_id"] = data["prw_id"][data["by_prw_id"]]
+    return data
+
+
+def _lookup(keys: np.ndarray, values: pd.Series) -> np.ndarray:
+    """
+    Position of each value in the sorted array keys, or -1 if not found or missing
+    """
+    pos = np.full(len(values), -1, dtype=np.int64)
+    valid = values.notna().to_numpy()
+    if not len(keys) or not valid.any():
+        return pos
+    strs = values[valid].astype(str).to_numpy(str)
+    found = np.searchsorted(keys, strs)
+    found[found == len(keys)] = 0
+    pos[valid] = np.where(keys[found] == strs, found, -1)
+    return pos
+
+
+def _take(values: np.ndarray, pos: np.ndarray, index: pd.Index, name: str) -> pd.Series:
+    """
+    Series of values at pos, with NA where pos is -1
+    """
+    if not len(values):
+        return pd.Series(pd.NA, index=index, name=name, dtype="string")
+    result = pd.Series(
+        values[np.maximum(pos, 0)], index=index, name=name, dtype="string"
+    )
+    return result.mask(pos < 0)
@@ -1,33 +1,122 @@
 """
-Utilities to handle upload/download from remote storage, including Cloudflare R2
+Utilities to handle upload/download from remote storage, including Cloudflare R2.
+Any S3-compatible endpoint works, e.g. a local MinIO or moto server for testing:
+http://localhost:9000/<bucket>
+
+sync_files_to_s3() uploads only files whose content changed since the last run, and
+keeps a JSON manifest object in the bucket listing each object's hash and version, so
+downstream apps can poll one small object to find out what changed.
+
+encrypt_and_upload_file_to_s3() encrypts a file and streams it into an S3 multipart
+upload as it goes, without writing the encrypted file to disk.
 """
 
 import os
+import json
+import time
+import queue
+import hashlib
 import logging
+import threading
 import boto3
+from dataclasses import dataclass
+from typing import BinaryIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from urllib.parse import urlparse
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+
+try:
+    from . import encrypt, metrics_utils
+except ImportError:
+    import encrypt, metrics_utils
+
+
+# Transfer settings for uploads and downloads. Files over 16MB are sent as concurrent
+# 16MB parts. R2 requires all parts except the last to be the same size.
+DEFAULT_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+# Connections per client. Enough for the parts of several concurrent transfers.
+_MAX_POOL_CONNECTIONS = 32
+
+# Default object name of the manifest written by sync_files_to_s3()
+DEFAULT_MANIFEST_NAME = "manifest.json"
+
+# Read size when hashing files
+_HASH_BUFFER_SIZE = 1024 * 1024
+
+# Process-wide S3 clients, keyed by endpoint, bucket and credentials
+_s3_clients: dict[tuple, boto3.client] = {}
+_s3_clients_lock = threading.Lock()
+
+
+@dataclass
+class TransferResult:
+    """
+    Outcome of transferring one file, returned by upload_files_to_s3() and
+    sync_files_to_s3()
+    """
+
+    file_path: str
+    s3_object_name: str
+    bytes: int = 0
+    elapsed: float = 0.0
+    error: Exception | None = None
+    skipped: bool = False
 
 
-def get_s3_client(url_and_bucket: str, auth_id_and_key: str) -> boto3.client:
+def get_s3_client(
+    url_and_bucket: str, auth_id_and_key: str, cache: bool = True
+) -> boto3.client:
     """
     Create an S3 client using the provided config information.
     URL in the format https://<baseurl>/<bucket>
     Auth information in the format <account_id>:<account_key>
     Returns an S3 client with an additional bucket attribute from the URL.
+
+    Clients are thread-safe and cached for the life of the process, so repeated calls
+    with the same arguments reuse one client and its connection pool. Pass cache=False
+    to always create a new client.
     """
     urlparts = urlparse(url_and_bucket)
     baseurl = f"{urlparts.scheme}://{urlparts.netloc}"
     bucket = urlparts.path.lstrip("/")
     acct_id, acct_key = auth_id_and_key.split(":")
-    s3_client = boto3.client(
-        "s3",
-        endpoint_url=baseurl,
-        region_name="auto",
-        aws_access_key_id=acct_id,
-        aws_secret_access_key=acct_key,
-    )
-    s3_client.bucket = bucket
-    return s3_client
+
+    key = (baseurl, bucket, acct_id, acct_key)
+    with _s3_clients_lock:
+        if cache and key in _s3_clients:
+            return _s3_clients[key]
+
+        s3_client = boto3.client(
+            "s3",
+            endpoint_url=baseurl,
+            region_name="auto",
+            aws_access_key_id=acct_id,
+            aws_secret_access_key=acct_key,
+            config=Config(max_pool_connections=_MAX_POOL_CONNECTIONS),
+        )
+        s3_client.bucket = bucket
+        if cache:
+            _s3_clients[key] = s3_client
+        return s3_client
+
+
+def clear_s3_clients():
+    """
+    Close and discard all cached S3 clients
+    """
+    with _s3_clients_lock:
+        for s3_client in _s3_clients.values():
+            s3_client.close()
+        _s3_clients.clear()
 
 
 def upload_file_to_s3(
@@ -35,8 +124,15 @@ def upload_file_to_s3(
     s3_auth_id_and_key: str,
     file_path: str,
     s3_object_name: str | None = None,
+    transfer_config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+    metadata: dict[str, str] | None = None,
+    hash_obj=None,
 ):
-    """Upload a file, file_path, to S3"""
+    """
+    Upload a file, file_path, to S3, optionally with user metadata for the object. If
+    hash_obj is given, such as hashlib.sha256(), it is updated with the file's content
+    as it is read for upload, so the file is not read again to hash it.
+    """
     # Create S3 client using provided endpoint URL and bucket with auth info
     s3_client = get_s3_client(s3_url_and_bucket, s3_auth_id_and_key)
 
@@ -44,5 +140,447 @@ def upload_file_to_s3(
     if s3_object_name is None:
         s3_object_name = os.path.basename(file_path)
 
+    size = os.path.getsize(file_path)
     logging.info(f"Uploading: {file_path} -> {s3_client.bucket}/{s3_object_name}")
-    s3_client.upload_file(file_path, s3_client.bucket, s3_object_name)
+    with metrics_utils.stage(s3_object_name, "upload", bytes=size):
+        start_time = time.perf_counter()
+        extra_args = {"Metadata": metadata} if metadata else None
+        if hash_obj is None:
+            s3_client.upload_file(
+                file_path,
+                s3_client.bucket,
+                s3_object_name,
+                ExtraArgs=extra_args,
+                Config=transfer_config,
+            )
+        else:
+            with open(file_path, "rb") as f:
+                s3_client.upload_fileobj(
+                    _HashingReader(f, hash_obj),
+                    s3_client.bucket,
+                    s3_object_name,
+                    ExtraArgs=extra_args,
+                    Config=transfer_config,
+                )
+    _log_throughput("Uploaded", s3_object_name, size, time.perf_counter() - start_time)
+
+
+def upload_files_to_s3(
+    s3_url_and_bucket: str,
+    s3_auth_id_and_key: str,
+    files: list[str] | dict[str, str],
+    max_workers: int = 4,
+    transfer_config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+    raise_on_error: bool = True,
+) -> list[TransferResult]:
+    """
+    Upload several files concurrently, up to max_workers at a time. files is a list of
+    paths, or a dict of path -> object name. Large files are also split into concurrent
+    parts per transfer_config. All files are attempted, then a RuntimeError is raised if
+    any failed. With raise_on_error=False, nothing is raised and failed files have
+    TransferResult.error set.
+    """
+    if not isinstance(files, dict):
+        files = {file_path: None for file_path in files}
+
+    def upload(item: tuple[str, str | None]) -> TransferResult:
+        file_path, s3_object_name = item
+        result = TransferResult(
+            file_path, s3_object_name or os.path.basename(file_path)
+        )
+        start_time = time.perf_counter()
+        try:
+            result.bytes = os.path.getsize(file_path)
+            upload_file_to_s3(
+                s3_url_and_bucket,
+                s3_auth_id_and_key,
+                file_path,
+                result.s3_object_name,
+                transfer_config,
+            )
+        except Exception as e:
+            result.error = e
+        result.elapsed = time.perf_counter() - start_time
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(upload, files.items()))
+
+    _check_transfer_results(results, raise_on_error)
+    return results
+
+
+def _check_transfer_results(results: list[TransferResult], raise_on_error: bool):
+    """
+    Log failed transfers, then raise a RuntimeError naming them if raise_on_error
+    """
+    failed = [result for result in results if result.error is not None]
+    for result in failed:
+        logging.error(f"ERROR: upload of {result.file_path} failed: {result.error}")
+    if failed and raise_on_error:
+        raise RuntimeError(
+            f"Failed to upload {len(failed)} of {len(results)} files: "
+            + ", ".join(result.file_path for result in failed)
+        ) from failed[0].error
+
+
+def download_file_from_s3(
+    s3_url_and_bucket: str,
+    s3_auth_id_and_key: str,
+    s3_object_name: str,
+    file_path: str | None = None,
+    transfer_config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+) -> str:
+    """
+    Download an object from S3 to file_path, by default the object's name in the current
+    directory. Returns the path downloaded to.
+    """
+    s3_client = get_s3_client(s3_url_and_bucket, s3_auth_id_and_key)
+    if file_path is None:
+        file_path = os.path.basename(s3_object_name)
+
+    logging.info(f"Downloading: {s3_client.bucket}/{s3_object_name} -> {file_path}")
+    with metrics_utils.stage(s3_object_name, "download") as stage:
+        start_time = time.perf_counter()
+        s3_client.download_file(
+            s3_client.bucket, s3_object_name, file_path, Config=transfer_config
+        )
+        stage.bytes = os.path.getsize(file_path)
+    _log_throughput(
+        "Downloaded", s3_object_name, stage.bytes, time.perf_counter() - start_time
+    )
+    return file_path
+
+
+def _log_throughput(action: str, s3_object_name: str, size: int, elapsed: float):
+    mb = size / 2**20
+    rate = f", {mb / elapsed:.1f} MB/s" if elapsed else ""
+    logging.info(f"{action} {s3_object_name}: {mb:.1f} MB in {elapsed:.2f}s{rate}")
+
+
+def encrypt_and_upload_file_to_s3(
+    s3_url_and_bucket: str,
+    s3_auth_id_and_key: str,
+    file_path: str,
+    key: str,
+    s3_object_name: str | None = None,
+    cipher: str = encrypt.DEFAULT_CIPHER,
+    compression: str | None = None,
+    level: int | None = None,
+    part_size: int = DEFAULT_TRANSFER_CONFIG.multipart_chunksize,
+    max_concurrency: int = DEFAULT_TRANSFER_CONFIG.max_concurrency,
+) -> int:
+    """
+    Encrypt file_path (see encrypt.encrypt_stream()) and upload the result directly to
+    S3 as a multipart upload, without a temporary file. The object name defaults to
+    the file name plus .enc.
+
+    The file is read and encrypted on the calling thread while up to max_concurrency
+    threads upload completed parts, so encryption and network transfer overlap. At
+    most about 2 * max_concurrency + 1 parts are held in memory. If anything fails, the
+    multipart upload is aborted. Returns the number of bytes uploaded.
+    """
+    s3_client = get_s3_client(s3_url_and_bucket, s3_auth_id_and_key)
+    if s3_object_name is None:
+        s3_object_name = os.path.basename(file_path) + ".enc"
+
+    logging.info(
+        f"Encrypting and uploading: {file_path} -> {s3_client.bucket}/{s3_object_name}"
+    )
+    with metrics_utils.stage(s3_object_name, "encrypt_upload") as stage:
+        start_time = time.perf_counter()
+        writer = _MultipartUploadWriter(
+            s3_client, s3_object_name, part_size, max_concurrency
+        )
+        try:
+            with open(file_path, "rb") as fin:
+                encrypt.encrypt_stream(
+                    fin,
+                    writer,
+                    key,
+                    cipher=cipher,
+                    compression=compression,
+                    level=level,
+                )
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        stage.bytes = writer.nbytes
+    _log_throughput(
+        "Encrypted and uploaded",
+        s3_object_name,
+        writer.nbytes,
+        time.perf_counter() - start_time,
+    )
+    return writer.nbytes
+
+
+class _MultipartUploadWriter:
+    """
+    Write-only file object that uploads everything written to it as an S3 multipart
+    upload. Full parts are queued for a pool of upload threads. The queue is bounded,
+    so write() blocks while the uploads catch up.
+    """
+
+    def __init__(
+        self, s3_client, s3_object_name: str, part_size: int, max_concurrency: int
+    ):
+        self.nbytes = 0
+        self._s3_client = s3_client
+        self._s3_object_name = s3_object_name
+        self._part_size = part_size
+        self._buf = bytearray()
+        self._part_number = 0
+        self._etags: dict[int, str] = {}
+        self._error: Exception | None = None
+        self._upload_id = s3_client.create_multipart_upload(
+            Bucket=s3_client.bucket, Key=s3_object_name
+        )["UploadId"]
+        self._queue = queue.Queue(maxsize=max_concurrency)
+        self._threads = [
+            threading.Thread(target=self._upload_parts, daemon=True)
+            for _ in range(max(1, max_concurrency))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def write(self, data: bytes) -> int:
+        self._buf += data
+        while len(self._buf) >= self._part_size:
+            self._put_part(bytes(self._buf[: self._part_size]))
+            del self._buf[: self._part_size]
+        return len(data)
+
+    def close(self):
+        """
+        Upload the last part, wait for all parts and complete the upload
+        """
+        if self._buf or not self._part_number:
+            self._put_part(bytes(self._buf))
+            self._buf.clear()
+        self._stop_threads()
+        if self._error:
+            raise self._error
+        self._s3_client.complete_multipart_upload(
+            Bucket=self._s3_client.bucket,
+            Key=self._s3_object_name,
+            UploadId=self._upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": part_number, "ETag": etag}
+                    for part_number, etag in sorted(self._etags.items())
+                ]
+            },
+        )
+
+    def abort(self):
+        """
+        Stop uploading and discard the parts already uploaded
+        """
+        if self._error is None:
+            self._error = RuntimeError("Upload aborted")
+        self._stop_threads()
+        try:
+            self._s3_client.abort_multipart_upload(
+                Bucket=self._s3_client.bucket,
+                Key=self._s3_object_name,
+                UploadId=self._upload_id,
+            )
+        except Exception as e:
+            logging.warning(f"Failed to abort upload of {self._s3_object_name}: {e}")
+
+    def _put_part(self, body: bytes):
+        self._part_number += 1
+        self.nbytes += len(body)
+        while True:
+            # Stop producing if an upload thread failed
+            if self._error:
+                raise self._error
+            try:
+                self._queue.put((self._part_number, body), timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _stop_threads(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _upload_parts(self):
+        while (item := self._queue.get()) is not None:
+            if self._error:
+                continue
+            part_number, body = item
+            try:
+                response = self._s3_client.upload_part(
+                    Bucket=self._s3_client.bucket,
+                    Key=self._s3_object_name,
+                    UploadId=self._upload_id,
+                    PartNumber=part_number,
+                    Body=body,
+                )
+                self._etags[part_number] = response["ETag"]
+            except Exception as e:
+                self._error = e
+
+
+def sync_files_to_s3(
+    s3_url_and_bucket: str,
+    s3_auth_id_and_key: str,
+    files: list[str] | dict[str, str],
+    manifest_name: str = DEFAULT_MANIFEST_NAME,
+    content_hashes: dict[str, str] | None = None,
+    max_workers: int = 4,
+    transfer_config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+    raise_on_error: bool = True,
+) -> list[TransferResult]:
+    """
+    Upload files whose content changed since they were last synced, and update the
+    manifest object in the bucket. files is a list of paths, or a dict of path -> object
+    name. A file whose size matches its manifest entry is hashed with SHA-256 and
+    skipped if the hash is unchanged. Other files have changed, and are hashed as they
+    are read for upload, so each file is read once. Objects carry their hash as sha256
+    metadata when it is known before the upload starts. The manifest always records it.
+
+    Encrypting the same data twice gives different output, so for encrypted files pass
+    content_hashes, a dict of path -> hash of the plaintext source (see hash_file()),
+    to skip re-uploads when the source is unchanged.
+
+    The manifest is updated for every file that uploaded, then a RuntimeError is raised
+    if any failed, unless raise_on_error=False. Returns a TransferResult per file, with
+    skipped set for unchanged files and error set for failed files.
+    """
+    if not isinstance(files, dict):
+        files = {file_path: None for file_path in files}
+    content_hashes = content_hashes or {}
+    manifest = get_s3_manifest(s3_url_and_bucket, s3_auth_id_and_key, manifest_name)
+    entries = manifest["objects"]
+
+    def sync(item: tuple[str, str | None]) -> tuple[TransferResult, str | None]:
+        file_path, s3_object_name = item
+        result = TransferResult(
+            file_path, s3_object_name or os.path.basename(file_path)
+        )
+        start_time = time.perf_counter()
+        content_hash = None
+        try:
+            result.bytes = os.path.getsize(file_path)
+            content_hash = content_hashes.get(file_path)
+            entry = entries.get(result.s3_object_name)
+            if content_hash is None and entry and entry.get("size") == result.bytes:
+                # Same size as when last synced, so hash to tell if it changed
+                content_hash = hash_file(file_path)
+            if entry and content_hash and entry.get("sha256") == content_hash:
+                logging.info(f"Unchanged, skipping upload: {file_path}")
+                result.skipped = True
+            else:
+                hash_obj = None if content_hash else hashlib.sha256()
+                upload_file_to_s3(
+                    s3_url_and_bucket,
+                    s3_auth_id_and_key,
+                    file_path,
+                    result.s3_object_name,
+                    transfer_config,
+                    metadata={"sha256": content_hash} if content_hash else None,
+                    hash_obj=hash_obj,
+                )
+                content_hash = content_hash or hash_obj.hexdigest()
+        except Exception as e:
+            result.error = e
+        result.elapsed = time.perf_counter() - start_time
+        return result, content_hash
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        synced = list(executor.map(sync, files.items()))
+
+    # Record uploaded files in the manifest, bumping each object's version
+    uploaded = [(r, h) for r, h in synced if r.error is None and not r.skipped]
+    if uploaded:
+        now = datetime.now(timezone.utc).isoformat()
+        for result, content_hash in uploaded:
+            previous = entries.get(result.s3_object_name, {})
+            entries[result.s3_object_name] = {
+                "sha256": content_hash,
+                "size": result.bytes,
+                "version": previous.get("version", 0) + 1,
+                "modified": now,
+            }
+        manifest["modified"] = now
+        put_s3_manifest(s3_url_and_bucket, s3_auth_id_and_key, manifest, manifest_name)
+
+    results = [result for result, _ in synced]
+    skipped = sum(result.skipped for result in results)
+    logging.info(
+        f"Synced {len(results)} files: {len(uploaded)} uploaded, {skipped} unchanged"
+    )
+    _check_transfer_results(results, raise_on_error)
+    return results
+
+
+def get_s3_manifest(
+    s3_url_and_bucket: str,
+    s3_auth_id_and_key: str,
+    manifest_name: str = DEFAULT_MANIFEST_NAME,
+) -> dict:
+    """
+    Return the manifest written by sync_files_to_s3(), or an empty manifest if there is
+    none. Format:
+        {"modified": <ISO time>, "objects": {<object name>: {"sha256", "size", "version", "modified"}}}
+    """
+    s3_client = get_s3_client(s3_url_and_bucket, s3_auth_id_and_key)
+    try:
+        response = s3_client.get_object(Bucket=s3_client.bucket, Key=manifest_name)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return {"modified": None, "objects": {}}
+        raise
+    return json.loads(response["Body"].read())
+
+
+def put_s3_manifest(
+    s3_url_and_bucket: str,
+    s3_auth_id_and_key: str,
+    manifest: dict,
+    manifest_name: str = DEFAULT_MANIFEST_NAME,
+):
+    """
+    Write the manifest object. Downstream apps poll it, so it is never cached.
+    """
+    s3_client = get_s3_client(s3_url_and_bucket, s3_auth_id_and_key)
+    s3_client.put_object(
+        Bucket=s3_client.bucket,
+        Key=manifest_name,
+        Body=json.dumps(manifest, indent=2).encode("utf-8"),
+        ContentType="application/json",
+        CacheControl="no-cache",
+    )
+
+
+class _HashingReader:
+    """
+    Read-only file wrapper that updates hash_obj with data as it is read. It is not
+    seekable, so boto3 reads it once, in order, and every byte is hashed exactly once.
+    """
+
+    def __init__(self, f: BinaryIO, hash_obj):
+        self._f = f
+        self._hash_obj = hash_obj
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self._hash_obj.update(data)
+        return data
+
+
+def hash_file(file_path: str) -> str:
+    """
+    SHA-256 hex digest of a file, read in a single streaming pass
+    """
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(_HASH_BUFFER_SIZE):
+            h.update(chunk)
+    return h.hexdigest()